@@ -1,11 +1,13 @@
 import shlex
 import subprocess
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import autoreload
 
 
-CMD = 'celery -A config worker --concurrency=2 -l info'
+# Development: single worker for both default and heavy import queues
+CMD = f'celery -A config worker --beat --concurrency=2 -Q celery,{settings.IMPORT_HEAVY_QUEUE} -l info'
 
 
 def restart_celery(*args, **kwargs):
@@ -2,7 +2,17 @@ from django.db import models
 
 
 class IndicatorData(models.Model):
+    iso3 = models.CharField(max_length=3)
+    indicator_id = models.CharField(max_length=255)
+    subvariable = models.CharField(max_length=255)
+    # Disaggregations
+    admin_level_1 = models.CharField(max_length=255, null=True)
+    area = models.CharField(max_length=255, null=True)
+    gender = models.CharField(max_length=255, null=True)
+    age_group = models.CharField(max_length=255, null=True)
+    target_group = models.CharField(max_length=255, null=True)
     indicator_value = models.FloatField(null=True)
+    insert_date = models.DateField(null=True)
 
     class Meta:
         managed = False
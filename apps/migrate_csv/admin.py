@@ -1,11 +1,12 @@
-from functools import reduce
+import json
 
 from django.contrib import admin
 from django.urls import path
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
 
 from django.utils.translation import gettext_lazy as _
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.contrib import messages
 
@@ -13,7 +14,17 @@ from admin_auto_filters.filters import AutocompleteFilterFactory
 
 from config.utils import get_admin_url
 
+from .pagination import EstimatedCountPaginator, KeysetChangeList
 from .views import CustomAutocompleteJsonView
+from .tasks import (
+    REVIEW_ASYNC_ROW_THRESHOLD,
+    cleanup_data_import,
+    delete_data_import,
+    fail_migrate_data_import,
+    migrate_data_import,
+    review_data_import,
+    review_data_import_previews,
+)
 from .models import (
     DataImport,
     ImportUserDataPreview,
@@ -21,6 +32,85 @@ from .models import (
 )
 
 
+@admin.action(description='Migrate reviewed previews to production database.', permissions=['change'])
+def migrate_to_production(modeladmin, request, queryset):
+    data_import_pks = list(
+        queryset.filter(
+            status__in=[DataImport.Status.PREVIEW, DataImport.Status.FAILED_MIGRATING],
+            assigned_to=request.user,
+        ).values_list('pk', flat=True)
+    )
+    for pk in data_import_pks:
+        transaction.on_commit(
+            lambda pk=pk: migrate_data_import.apply_async(
+                (pk, request.user.pk),
+                link_error=fail_migrate_data_import.s(pk),
+            )
+        )
+    messages.add_message(
+        request, messages.INFO,
+        mark_safe(_('Migration started for %s imports') % (len(data_import_pks)))
+    )
+
+
+def _review_data_imports(request, queryset, only_non_outliers):
+    data_imports = queryset.filter(
+        status=DataImport.Status.PREVIEW,
+        assigned_to=request.user,
+    )
+    sync_count = async_count = 0
+    for data_import in data_imports:
+        if data_import.total_rows >= REVIEW_ASYNC_ROW_THRESHOLD:
+            transaction.on_commit(
+                lambda pk=data_import.pk: review_data_import.delay(pk, request.user.pk, only_non_outliers)
+            )
+            async_count += 1
+        else:
+            sync_count += review_data_import_previews(data_import, request.user.pk, only_non_outliers)
+    messages.add_message(
+        request, messages.INFO,
+        mark_safe(
+            _('Successfully marked %s previews, review started for %s large imports') % (sync_count, async_count)
+        )
+    )
+
+
+@admin.action(description='Mark all non-outlier previews as reviewed.')
+def review_non_outlier_previews(modeladmin, request, queryset):
+    _review_data_imports(request, queryset, only_non_outliers=True)
+
+
+@admin.action(description='Mark all previews as reviewed.')
+def review_all_previews(modeladmin, request, queryset):
+    _review_data_imports(request, queryset, only_non_outliers=False)
+
+
+@admin.action(description='Cancel imports and remove their previews.')
+def cancel_data_imports(modeladmin, request, queryset):
+    with transaction.atomic():
+        # Locked: process_data_import and migrate_data_import claim imports after this update.
+        # See DataImport.IN_USE_STATUS
+        data_import_pks = list(
+            queryset.filter(
+                created_by=request.user,
+                status__in=[
+                    DataImport.Status.PENDING,
+                    DataImport.Status.PREVIEW,
+                    DataImport.Status.FAILED_PROCESSING,
+                ],
+            ).select_for_update().values_list('pk', flat=True)
+        )
+        DataImport.objects.filter(pk__in=data_import_pks).update(status=DataImport.Status.CANCELED)
+    for pk in data_import_pks:
+        transaction.on_commit(
+            lambda pk=pk: cleanup_data_import.delay(pk)
+        )
+    messages.add_message(
+        request, messages.INFO,
+        mark_safe(_('Canceled %s imports') % (len(data_import_pks)))
+    )
+
+
 @admin.register(DataImport)
 class DataImportAdmin(admin.ModelAdmin):
     list_display = [
@@ -33,7 +123,9 @@ class DataImportAdmin(admin.ModelAdmin):
         'updated_at',
         'assigned_to',
         'assigned_at',
-        'reviewed_count',
+        'total_rows',
+        'reviewed_rows',
+        'outlier_rows',
         'migrated_by',
         'migrated_at',
     ]
@@ -49,37 +141,60 @@ class DataImportAdmin(admin.ModelAdmin):
         'updated_by', 'updated_at',
         'migrated_at', 'migrated_by',
         'assigned_at',
+        'checksum',
+        'previews_modified',
+        'parsed_rows', 'inserted_rows', 'last_committed_chunk',
+        'total_rows', 'reviewed_rows', 'outlier_rows',
+        'estimated_memory_mb',
+        'metrics_display',
+        'last_migrated_preview_id',
+        'migrating_transaction_id', 'migrating_preview_id',
     ]
     list_filter = [
         AutocompleteFilterFactory('Created By', 'created_by'),
         'file_type',
         'status',
     ]
-
-    def get_queryset(self, request):
-        reviewed_count_annotate = reduce(
-            lambda a, b: a + b,
-            [
-                models.functions.Coalesce(
-                    models.Subquery(
-                        model.objects.filter(
-                            importer=models.OuterRef('pk'),
-                            is_reviewed=True,
-                        ).values('importer').order_by().annotate(
-                            count=models.Count('id'),
-                        ).values('count')[:1], output_field=models.IntegerField()
-                    ), 0
-                )
-                for model in DataImport.FILE_TYPE_TO_MODEL_MAP.values()
-            ],
-        )
-        return super().get_queryset(request).annotate(reviewed_count=reviewed_count_annotate)
+    actions = [migrate_to_production, review_non_outlier_previews, review_all_previews, cancel_data_imports]
 
     def has_delete_permission(self, request, obj=None):
         if obj:
-            return obj.created_by == request.user
+            return obj.created_by == request.user and obj.status not in DataImport.IN_USE_STATUS
         return True
 
+    def get_deleted_objects(self, objs, request):
+        # Previews are not collected for the confirmation page (removed by a celery task)
+        return (
+            [str(obj) for obj in objs],
+            {self.opts.verbose_name_plural: len(objs)},
+            set(),
+            [],
+        )
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, DataImport.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        # Imports are canceled right away, previews and imports are removed by a celery task
+        with transaction.atomic():
+            # Locked: process_data_import and migrate_data_import claim imports after this update
+            data_import_pks = list(
+                queryset.exclude(
+                    status__in=DataImport.IN_USE_STATUS,
+                ).select_for_update().values_list('pk', flat=True)
+            )
+            DataImport.objects.filter(pk__in=data_import_pks).update(status=DataImport.Status.CANCELED)
+        skipped_count = queryset.exclude(pk__in=data_import_pks).count()
+        if skipped_count:
+            messages.add_message(
+                request, messages.WARNING,
+                mark_safe(_('%s imports are being processed or migrated, they are not deleted') % skipped_count)
+            )
+        for pk in data_import_pks:
+            transaction.on_commit(
+                lambda pk=pk: delete_data_import.delay(pk)
+            )
+
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
@@ -110,16 +225,18 @@ class DataImportAdmin(admin.ModelAdmin):
     def created_by(self, obj):
         return obj.created_by and obj.created_by.full_name
 
+    @admin.display(description=_('Metrics'))
+    def metrics_display(self, obj):
+        if not obj.metrics:
+            return '-'
+        return format_html('<pre>{}</pre>', json.dumps(obj.metrics, indent=2))
+
     def updated_by(self, obj):
         return obj.updated_by and obj.updated_by.full_name
 
     def assigned_to(self, obj):
         return obj.assigned_to and obj.assigned_to.full_name
 
-    @admin.display
-    def reviewed_count(self, obj):
-        return obj.reviewed_count
-
     def save_model(self, request, obj, form, change):
         obj.updated_by = request.user
         if obj.pk is None:
@@ -135,11 +252,14 @@ class DataImportAdmin(admin.ModelAdmin):
 
 @admin.action(description='Bulk mark previews as reviewed.')
 def bulk_review_true(modeladmin, request, queryset):
-    count = queryset.update(
-        is_reviewed=True,
-        reviewed_by=request.user,
-        reviewed_at=timezone.now(),
-    )
+    data_import_pks = list(queryset.values_list('importer', flat=True).order_by().distinct())
+    with transaction.atomic():
+        count = queryset.update(
+            is_reviewed=True,
+            reviewed_by=request.user,
+            reviewed_at=timezone.now(),
+        )
+        DataImport.update_preview_counters(data_import_pks)
     messages.add_message(
         request, messages.INFO,
         mark_safe(_('Successfully marked %s previews') % (count))
@@ -148,11 +268,14 @@ def bulk_review_true(modeladmin, request, queryset):
 
 @admin.action(description='Bulk mark previews as not reviewed.')
 def bulk_review_false(modeladmin, request, queryset):
-    count = queryset.update(
-        is_reviewed=False,
-        reviewed_by=None,
-        reviewed_at=None,
-    )
+    data_import_pks = list(queryset.values_list('importer', flat=True).order_by().distinct())
+    with transaction.atomic():
+        count = queryset.update(
+            is_reviewed=False,
+            reviewed_by=None,
+            reviewed_at=None,
+        )
+        DataImport.update_preview_counters(data_import_pks)
     messages.add_message(
         request, messages.INFO,
         mark_safe(_('Successfully unmarked %s previews') % (count))
@@ -183,6 +306,13 @@ class ImportUserDataPreviewBaseAdmin(admin.ModelAdmin):
         'is_reviewed',
     ]
     actions = [bulk_review_true, bulk_review_false]
+    # Keyset pagination (by id) with planner estimated count, see KeysetChangeList
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
 
     def get_queryset(self, request):
         return super().get_queryset(request).filter(
@@ -230,8 +360,25 @@ class ImportUserDataPreviewBaseAdmin(admin.ModelAdmin):
             elif existing_obj.is_reviewed != obj.is_reviewed:
                 obj.reviewed_by = request.user
                 obj.reviewed_at = timezone.now()
+            if existing_obj.is_reviewed != obj.is_reviewed:
+                DataImport.objects.filter(pk=obj.importer_id).update(
+                    reviewed_rows=models.F('reviewed_rows') + (1 if obj.is_reviewed else -1),
+                )
+            if set(form.changed_data) & set(obj.CSV_HEADERS):
+                DataImport.objects.filter(pk=obj.importer_id).update(previews_modified=True)
         super().save_model(request, obj, form, change)
 
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        DataImport.objects.filter(pk=obj.importer_id).update(previews_modified=True)
+        DataImport.update_preview_counters([obj.importer_id])
+
+    def delete_queryset(self, request, queryset):
+        data_import_pks = list(queryset.values_list('importer', flat=True).order_by().distinct())
+        super().delete_queryset(request, queryset)
+        DataImport.objects.filter(pk__in=data_import_pks).update(previews_modified=True)
+        DataImport.update_preview_counters(data_import_pks)
+
 
 @admin.register(ImportUserDataPreview)
 class ImportUserDataPreviewAdmin(ImportUserDataPreviewBaseAdmin):
@@ -0,0 +1,40 @@
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# Redis sorted set of running heavy imports (member: DataImport pk, score: lease expiry timestamp)
+HEAVY_IMPORT_SLOTS_KEY = 'migrate_csv:heavy_import_slots'
+
+# Expired leases (crashed workers) are dropped first, holder of a slot can re-acquire (extend) it.
+ACQUIRE_SLOT_SCRIPT = '''
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    return 1
+end
+return 0
+'''
+
+
+def acquire_heavy_import_slot(pk):
+    """
+    Counting semaphore limiting heavy imports running at once to IMPORT_HEAVY_MAX_CONCURRENCY.
+    Return False if all slots are taken.
+    """
+    now = time.time()
+    return bool(
+        get_redis_connection('default').eval(
+            ACQUIRE_SLOT_SCRIPT,
+            1,
+            HEAVY_IMPORT_SLOTS_KEY,
+            pk,
+            now,
+            now + settings.IMPORT_HEAVY_SLOT_TTL,
+            settings.IMPORT_HEAVY_MAX_CONCURRENCY,
+        )
+    )
+
+
+def release_heavy_import_slot(pk):
+    get_redis_connection('default').zrem(HEAVY_IMPORT_SLOTS_KEY, pk)
@@ -0,0 +1,117 @@
+import datetime
+import os
+import time
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+from django.core.files import File
+from django.db import connections, models
+from django.test.utils import CaptureQueriesContext
+
+from .metrics import get_peak_rss_mb, reset_peak_rss
+from .models import DataImport
+from .outlier_detect import OUTLIER_DETECTORS
+from .partitions import create_preview_partition
+from .tasks import delete_data_import, process_data_import
+
+# Rows generated (and written) at once by generate_import_csv
+GENERATE_CHUNK_SIZE = 100000
+# Distinct values per text column
+GENERATE_TEXT_CARDINALITY = 20
+# Injected outliers are this many times the regular values
+GENERATE_OUTLIER_FACTOR = 10
+
+GENERATE_TEXT_VALUES = {
+    'iso3': ['NPL', 'IND', 'BGD', 'KEN', 'NGA', 'COD', 'PAK', 'ETH'],
+    'indicator_id': [f'ind{i}' for i in range(10)],
+    'subindicator': [f'sub{i}' for i in range(4)],
+}
+
+
+def _generate_column(field, rng, size):
+    if isinstance(field, models.IntegerField):
+        return rng.integers(100, 1000, size)
+    if isinstance(field, models.FloatField):
+        return rng.normal(50, 5, size).clip(0, 100)
+    if isinstance(field, models.DateField):
+        today = datetime.date.today()
+        return pd.to_datetime(today) - pd.to_timedelta(rng.integers(0, 365, size), unit='D')
+    values = GENERATE_TEXT_VALUES.get(field.name) or [
+        f'{field.name}-{i}' for i in range(GENERATE_TEXT_CARDINALITY)
+    ]
+    return rng.choice(values, size)
+
+
+def generate_import_df(model, size, outlier_ratio=0.01, rng=None):
+    """
+    Synthetic rows for model CSV_HEADERS, outlier_ratio of the rows get an outlier value
+    in each column with registered outlier detectors.
+    """
+    rng = rng or np.random.default_rng()
+    df = pd.DataFrame({
+        header: _generate_column(model._meta.get_field(header), rng, size)
+        for header in model.CSV_HEADERS
+    })
+    for column in OUTLIER_DETECTORS.get(model, {}):
+        is_outlier = rng.random(size) < outlier_ratio
+        df.loc[is_outlier, column] = df.loc[is_outlier, column] * GENERATE_OUTLIER_FACTOR
+    return df
+
+
+def generate_import_csv(path, file_type, rows, outlier_ratio=0.01, seed=None):
+    """
+    Write a synthetic CSV for file_type, generated chunk by chunk (memory is bounded for large files).
+    """
+    model = DataImport.FILE_TYPE_TO_MODEL_MAP[DataImport.FileType(file_type)]
+    rng = np.random.default_rng(seed)
+    with open(path, 'w', newline='') as file:
+        for start in range(0, rows, GENERATE_CHUNK_SIZE):
+            size = min(GENERATE_CHUNK_SIZE, rows - start)
+            generate_import_df(model, size, outlier_ratio, rng).to_csv(
+                file, header=start == 0, index=False, date_format='%Y-%m-%d',
+            )
+    return path
+
+
+def run_import_benchmark(path, file_type, keep=False):
+    """
+    Process the file end-to-end (synchronously) and return its measures.
+    DataImport is created with bulk_create to skip the celery dispatch.
+    """
+    with open(path, 'rb') as file:
+        data_import = DataImport(file_type=file_type)
+        data_import.file.save(os.path.basename(path), File(file), save=False)
+    data_import, = DataImport.objects.bulk_create([data_import])
+    create_preview_partition(data_import.preview_model, data_import.pk)
+
+    reset_peak_rss()
+    with ExitStack() as stack:
+        contexts = [
+            stack.enter_context(CaptureQueriesContext(connections[alias]))
+            for alias in connections
+        ]
+        start = time.perf_counter()
+        process_data_import(data_import.pk)
+        duration = time.perf_counter() - start
+
+    data_import.refresh_from_db()
+    result = {
+        'file': os.path.basename(path),
+        'status': data_import.get_status_display(),
+        'rows': data_import.total_rows,
+        'outlier_rows': data_import.outlier_rows,
+        'seconds': round(duration, 3),
+        'rows_per_second': round(data_import.total_rows / duration) if duration else None,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'queries': {
+            context.connection.alias: len(context.captured_queries)
+            for context in contexts
+            if context.captured_queries
+        },
+        'stages': data_import.metrics.get('stages', {}),
+    }
+    if not keep:
+        data_import.file.delete(save=False)
+        delete_data_import(data_import.pk)
+    return result
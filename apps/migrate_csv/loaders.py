@@ -0,0 +1,218 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+from django.db import connections, models, router
+from psycopg2.extras import execute_values
+
+from .metrics import ImportMetrics
+
+# Number of preview rows sent per INSERT statement (ORM fallback)
+IMPORT_BULK_CREATE_BATCH_SIZE = 2000
+
+
+def get_outlier_data_per_row(outliers, encode=None):
+    """
+    Return outlier column list for each row (in df order).
+    outliers: OutlierResult as returned by detect_outliers
+    encode: optional function applied once per distinct column list
+    """
+    columns = np.array(outliers.columns, dtype=object)
+    # Only a few distinct combinations exist, build the lists once per combination
+    unique_masks, row_to_unique = np.unique(outliers.mask, axis=0, return_inverse=True)
+    unique_outlier_data = [
+        encode(columns[unique_mask].tolist()) if encode else columns[unique_mask].tolist()
+        for unique_mask in unique_masks
+    ]
+    return [
+        unique_outlier_data[unique_index]
+        for unique_index in row_to_unique.ravel()
+    ]
+
+
+def bulk_create_preview_rows(data_import, df, outliers, metrics):
+    PREVIEW_MODEL = data_import.preview_model
+    with metrics.stage('build'):
+        rows = df[PREVIEW_MODEL.CSV_HEADERS].to_dict('records')
+        new_preview_objects = [
+            PREVIEW_MODEL(
+                importer=data_import,
+                no_outlier=not row_outlier_data,
+                outlier_data=row_outlier_data,
+                **row,
+            )
+            for row, row_outlier_data in zip(rows, get_outlier_data_per_row(outliers))
+        ]
+    with metrics.stage('insert'):
+        PREVIEW_MODEL.objects.bulk_create(new_preview_objects, batch_size=IMPORT_BULK_CREATE_BATCH_SIZE)
+    return len(new_preview_objects)
+
+
+def _get_copy_column_values(field, data_import, df, outliers, connection):
+    if field.name == 'importer':
+        return data_import.pk
+    if field.name == 'no_outlier':
+        return ~outliers.rows
+    if field.name == 'outlier_data':
+        return get_outlier_data_per_row(outliers, encode=json.dumps)
+    if field.name not in data_import.preview_model.CSV_HEADERS:
+        return field.get_db_prep_save(field.get_default(), connection=connection)
+    series = df[field.name]
+    if isinstance(field, (models.CharField, models.TextField)):
+        # Same as ORM: empty value for missing text
+        return series.astype(object).where(series.notna(), '')
+    if isinstance(field, models.IntegerField):
+        # Missing values makes pandas use float columns, which postgres won't accept as integer.
+        return series.astype('Int64')
+    if isinstance(field, models.FloatField):
+        # Same as ORM: NaN is a valid float value for postgres
+        return series.astype(object).where(series.notna(), 'NaN')
+    return series
+
+
+def copy_preview_rows(data_import, df, outliers, using, metrics):
+    """
+    Write previews using postgres COPY FROM STDIN, rows are streamed through an in-memory CSV buffer.
+    """
+    PREVIEW_MODEL = data_import.preview_model
+    connection = connections[using]
+    fields = [
+        field
+        for field in PREVIEW_MODEL._meta.concrete_fields
+        if not field.primary_key
+    ]
+    with metrics.stage('build'):
+        copy_df = pd.DataFrame(
+            {
+                field.column: _get_copy_column_values(field, data_import, df, outliers, connection)
+                for field in fields
+            },
+            index=df.index,
+        )
+        buffer = io.StringIO()
+        copy_df.to_csv(buffer, header=False, index=False)
+        buffer.seek(0)
+
+    qn = connection.ops.quote_name
+    # Empty text is not NULL for these
+    force_not_null_columns = [
+        qn(field.column)
+        for field in fields
+        if isinstance(field, (models.CharField, models.TextField))
+    ]
+    copy_options = ['FORMAT csv']
+    if force_not_null_columns:
+        copy_options.append(f"FORCE_NOT_NULL ({', '.join(force_not_null_columns)})")
+    sql = (
+        f'COPY {qn(PREVIEW_MODEL._meta.db_table)} ({", ".join(qn(field.column) for field in fields)})'
+        f' FROM STDIN WITH ({", ".join(copy_options)})'
+    )
+    with metrics.stage('insert'), connection.cursor() as cursor:
+        cursor.copy_expert(sql, buffer)
+    return len(copy_df)
+
+
+def insert_preview_rows(data_import, df, outliers, metrics=None):
+    """
+    Insert previews for df rows, COPY is used for postgres and ORM bulk_create otherwise.
+    Time spent building and writing rows is added to metrics ('build' and 'insert' stages).
+    """
+    PREVIEW_MODEL = data_import.preview_model
+    metrics = metrics or ImportMetrics()
+    using = router.db_for_write(PREVIEW_MODEL)
+    if connections[using].vendor == 'postgresql':
+        return copy_preview_rows(data_import, df, outliers, using, metrics)
+    return bulk_create_preview_rows(data_import, df, outliers, metrics)
+
+
+def clone_preview_rows(source_data_import, data_import):
+    """
+    Copy previews of source_data_import to data_import using INSERT ... SELECT (no data leaves the database).
+    Review attributes are reset, source previews should be unmodified (see DataImport.get_processed_duplicate).
+    """
+    PREVIEW_MODEL = data_import.preview_model
+    connection = connections[router.db_for_write(PREVIEW_MODEL)]
+    qn = connection.ops.quote_name
+    overwrite_values = {
+        'importer': data_import.pk,
+        'is_reviewed': False,
+        'reviewed_by': None,
+        'reviewed_at': None,
+    }
+    columns = []
+    select_columns = []
+    params = []
+    for field in PREVIEW_MODEL._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        columns.append(qn(field.column))
+        if field.name in overwrite_values:
+            select_columns.append('%s')
+            params.append(overwrite_values[field.name])
+        else:
+            select_columns.append(qn(field.column))
+    importer_column = PREVIEW_MODEL._meta.get_field('importer').column
+    sql = (
+        f'INSERT INTO {qn(PREVIEW_MODEL._meta.db_table)} ({", ".join(columns)})'
+        f' SELECT {", ".join(select_columns)} FROM {qn(PREVIEW_MODEL._meta.db_table)}'
+        f' WHERE {qn(importer_column)} = %s ORDER BY {qn(PREVIEW_MODEL._meta.pk.column)}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [*params, source_data_import.pk])
+        return cursor.rowcount
+
+
+def get_production_column_map(model):
+    """
+    Preview column -> Production column (Columns mapped to None are not migrated)
+    """
+    return {
+        csv_column: db_column
+        for csv_column, db_column in model.DATA_DB_COLUMN_MAP.items()
+        if db_column
+    }
+
+
+def migrate_preview_rows(model, rows, using):
+    """
+    Write preview rows (dicts from .values()) to production table model.DATA_DB_TABLE_NAME.
+    Production tables have no unique key for previews, re-running a committed batch duplicates its rows.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    column_map = get_production_column_map(model)
+    sql = (
+        f'INSERT INTO {qn(model.DATA_DB_TABLE_NAME)} ({", ".join(qn(column) for column in column_map.values())})'
+        ' VALUES %s'
+    )
+    with connection.cursor() as cursor:
+        execute_values(
+            # Raw psycopg2 cursor
+            cursor.cursor,
+            sql,
+            [
+                tuple(row[csv_column] for csv_column in column_map.keys())
+                for row in rows
+            ],
+            page_size=len(rows),
+        )
+        return cursor.rowcount
+
+
+def get_transaction_id(using):
+    """
+    Id of the current transaction of the connection (assigned if none yet)
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT txid_current()')
+        return cursor.fetchone()[0]
+
+
+def get_transaction_status(transaction_id, using):
+    """
+    'committed', 'aborted', 'in progress' or None (too old to be known)
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT txid_status(%s)', [transaction_id])
+        return cursor.fetchone()[0]
@@ -0,0 +1,42 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from apps.migrate_csv.benchmark import generate_import_csv, run_import_benchmark
+from apps.migrate_csv.models import DataImport
+from config.celery import app
+
+
+class Command(BaseCommand):
+    help = 'Run DataImport processing end-to-end on synthetic (or given) CSV files and report measures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', action='append', default=[], help='Use existing file (repeatable)')
+        parser.add_argument(
+            '--file-type', type=int, default=DataImport.FileType.USER,
+            choices=DataImport.FileType.values,
+        )
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--outlier-ratio', type=float, default=0.01)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='Keep DataImport and previews')
+
+    def handle(self, *args, **options):
+        # Parallel parts (celery chord) are also run in this process
+        app.conf.task_always_eager = True
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = options['file'] or [
+                generate_import_csv(
+                    os.path.join(tmp_dir, f'benchmark-{options["file_type"]}-{rows}.csv'),
+                    options['file_type'],
+                    rows,
+                    outlier_ratio=options['outlier_ratio'],
+                    seed=options['seed'],
+                )
+                for rows in options['rows']
+            ]
+            for path in files:
+                result = run_import_benchmark(path, options['file_type'], keep=options['keep'])
+                self.stdout.write(json.dumps(result))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from apps.migrate_csv.benchmark import generate_import_csv
+from apps.migrate_csv.models import DataImport
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic CSV files for DataImport (benchmarks)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='CSV file path')
+        parser.add_argument(
+            '--file-type', type=int, default=DataImport.FileType.USER,
+            choices=DataImport.FileType.values,
+        )
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--outlier-ratio', type=float, default=0.01)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        path = generate_import_csv(
+            options['output'],
+            options['file_type'],
+            options['rows'],
+            outlier_ratio=options['outlier_ratio'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS('Generated %s rows in %s' % (options['rows'], path)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from apps.migrate_csv.models import IndicatorDataOutlierBaseline
+from apps.migrate_csv.outlier_detect import update_outlier_baselines
+
+
+class Command(BaseCommand):
+    help = 'Recompute outlier baselines from indicator data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--if-empty',
+            action='store_true',
+            help='Only when there are no baselines yet (eg: on deploy, before the first periodic refresh)',
+        )
+
+    def handle(self, *args, **options):
+        if options['if_empty'] and IndicatorDataOutlierBaseline.objects.exists():
+            self.stdout.write('Outlier baselines already exist')
+            return
+        count = update_outlier_baselines()
+        self.stdout.write(self.style.SUCCESS('Updated %s outlier baselines' % count))
@@ -0,0 +1,89 @@
+import time
+from contextlib import contextmanager
+
+
+def reset_peak_rss():
+    # Linux only: resets the peak RSS (VmHWM) of this process, return False if not supported
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss_mb():
+    # Peak RSS (VmHWM) since the last reset_peak_rss, None if not supported
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+
+
+class ImportMetrics:
+    """
+    Per-stage durations (in seconds) and row counts of an import, stored in DataImport.metrics
+    """
+    def __init__(self, data=None):
+        data = data or {}
+        self.stages = dict(data.get('stages', {}))
+        self.rows = dict(data.get('rows', {}))
+        self.peak_rss_mb = data.get('peak_rss_mb')
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def iter_stage(self, name, iterable):
+        # Time spent producing each item is added to the stage (e.g. reading chunks)
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def track_peak_rss(self):
+        # Worker processes are re-used by other tasks, the peak is only measured inside this block
+        is_reset = reset_peak_rss()
+        try:
+            yield
+        finally:
+            if is_reset:
+                self.add_peak_rss(get_peak_rss_mb())
+
+    def add_peak_rss(self, peak_rss_mb):
+        if peak_rss_mb is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb or 0, peak_rss_mb)
+
+    def add_rows(self, name, count):
+        self.rows[name] = self.rows.get(name, 0) + int(count)
+
+    def merge(self, data):
+        # Sum metrics of another run (e.g. parallel parts)
+        other = ImportMetrics(data)
+        for name, duration in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0) + duration
+        for name, count in other.rows.items():
+            self.add_rows(name, count)
+        self.add_peak_rss(other.peak_rss_mb)
+
+    def as_dict(self):
+        return {
+            'stages': {
+                name: round(duration, 3)
+                for name, duration in self.stages.items()
+            },
+            'rows': self.rows,
+            'peak_rss_mb': self.peak_rss_mb,
+        }
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0008_cachedcountryfilteroptions_thematic_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='checksum',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0009_dataimport_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='last_migrated_preview_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0010_dataimport_last_migrated_preview_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='inserted_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='last_committed_chunk',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='parsed_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0011_dataimport_inserted_rows_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndicatorDataOutlierBaseline',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('indicator_id', models.CharField(max_length=255)),
+                ('subvariable', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('mean', models.FloatField(blank=True, null=True)),
+                ('m2', models.FloatField(blank=True, null=True)),
+                ('quantiles', models.JSONField(blank=True, default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('indicator_id', 'subvariable')},
+            },
+        ),
+    ]
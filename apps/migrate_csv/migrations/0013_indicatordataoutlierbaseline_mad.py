@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0012_indicatordataoutlierbaseline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indicatordataoutlierbaseline',
+            name='mad',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:29
+
+from django.db import migrations, models
+
+
+def backfill_preview_counters(apps, schema_editor):
+    DataImport = apps.get_model('migrate_csv', 'DataImport')
+    file_type_to_model_map = {
+        0: apps.get_model('migrate_csv', 'ImportUserDataPreview'),
+        1: apps.get_model('migrate_csv', 'ImportUserSourceDataPreview'),
+    }
+
+    def _count(PREVIEW_MODEL, **filters):
+        return models.functions.Coalesce(
+            models.Subquery(
+                PREVIEW_MODEL.objects.filter(
+                    importer=models.OuterRef('pk'),
+                    **filters,
+                ).values('importer').order_by().annotate(
+                    count=models.Count('id'),
+                ).values('count')[:1], output_field=models.IntegerField()
+            ), 0
+        )
+
+    for file_type, PREVIEW_MODEL in file_type_to_model_map.items():
+        DataImport.objects.filter(file_type=file_type).update(
+            total_rows=_count(PREVIEW_MODEL),
+            reviewed_rows=_count(PREVIEW_MODEL, is_reviewed=True),
+            outlier_rows=_count(PREVIEW_MODEL, no_outlier=False),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0013_indicatordataoutlierbaseline_mad'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='outlier_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='reviewed_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='total_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_preview_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:45
+
+from django.conf import settings
+from django.db import migrations
+
+PREVIEW_MODELS = ['ImportUserDataPreview', 'ImportUserSourceDataPreview']
+
+
+def partition_preview_tables(apps, schema_editor):
+    """
+    Re-create preview tables as LIST partitioned by importer_id (postgres only).
+    Primary key must include the partition key, so it becomes (id, importer_id).
+    Existing previews are copied into one partition per import.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    qn = connection.ops.quote_name
+    data_import_table = qn(apps.get_model('migrate_csv', 'DataImport')._meta.db_table)
+    user_table = qn(apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table)
+    for model_name in PREVIEW_MODELS:
+        model = apps.get_model('migrate_csv', model_name)
+        db_table = model._meta.db_table
+        table, new_table = qn(db_table), qn(f'{db_table}_partitioned')
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+            cursor.execute(
+                f'CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS) PARTITION BY LIST (importer_id)'
+            )
+            cursor.execute(f'ALTER TABLE {new_table} ADD PRIMARY KEY (id, importer_id)')
+            cursor.execute(f'CREATE TABLE {qn(f"{db_table}_default")} PARTITION OF {new_table} DEFAULT')
+            cursor.execute(f'SELECT DISTINCT importer_id FROM {table}')
+            for (importer_id,) in cursor.fetchall():
+                cursor.execute(
+                    f'CREATE TABLE {qn(f"{db_table}_p{importer_id}")} PARTITION OF {new_table}'
+                    ' FOR VALUES IN (%s)',
+                    [importer_id],
+                )
+            cursor.execute(f'INSERT INTO {new_table} SELECT * FROM {table}')
+            cursor.execute(f'SELECT MAX(id) FROM {table}')
+            max_id = cursor.fetchone()[0]
+            cursor.execute(f'DROP TABLE {table}')
+            cursor.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+            # Identity columns are not supported on partitioned tables (postgres < 17)
+            sequence = qn(f'{db_table}_id_seq')
+            cursor.execute(f'CREATE SEQUENCE {sequence} OWNED BY {table}.id')
+            cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+            cursor.execute('SELECT setval(%s, %s, %s)', [sequence, max_id or 1, max_id is not None])
+            cursor.execute(
+                f'ALTER TABLE {table} ADD CONSTRAINT {qn(f"{db_table}_importer_id_fk")}'
+                f' FOREIGN KEY (importer_id) REFERENCES {data_import_table} (id)'
+                ' DEFERRABLE INITIALLY DEFERRED'
+            )
+            cursor.execute(
+                f'ALTER TABLE {table} ADD CONSTRAINT {qn(f"{db_table}_reviewed_by_id_fk")}'
+                f' FOREIGN KEY (reviewed_by_id) REFERENCES {user_table} (id)'
+                ' DEFERRABLE INITIALLY DEFERRED'
+            )
+            cursor.execute(f'CREATE INDEX {qn(f"{db_table}_reviewed_by_id")} ON {table} (reviewed_by_id)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('migrate_csv', '0014_dataimport_outlier_rows_dataimport_reviewed_rows_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_preview_tables, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0015_partition_previews_by_importer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
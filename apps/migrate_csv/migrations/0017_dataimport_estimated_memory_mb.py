@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0016_dataimport_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='estimated_memory_mb',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.5 on 2026-10-18 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0017_dataimport_estimated_memory_mb'),
+    ]
+
+    operations = [
+        # Review history of existing imports is unknown, they are not re-used for duplicates
+        migrations.AddField(
+            model_name='dataimport',
+            name='previews_modified',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='dataimport',
+            name='previews_modified',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.5 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0018_dataimport_previews_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='migrating_preview_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='migrating_transaction_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('migrate_csv', '0019_dataimport_migrating_batch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dataimport',
+            name='status',
+            field=models.SmallIntegerField(choices=[(0, 'Pending'), (1, 'Processing (Extraction + Outlier Detection)'), (2, 'Preview'), (3, 'Migrated'), (4, 'Canceled'), (5, 'Migrating'), (500, 'Failed Processing'), (501, 'Failed Migrating')], default=0),
+        ),
+    ]
@@ -1,63 +1,123 @@
+import codecs
 import csv
+import hashlib
 import logging
 
+import pyarrow as pa
+from django.conf import settings
 from django.db import models, transaction
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 
+from .metrics import ImportMetrics
+from .partitions import create_preview_partition, drop_preview_partition
+from .readers import (
+    FILE_READ_ERRORS,
+    FileFormat,
+    format_column,
+    get_file_format,
+    open_csv_stream,
+    read_columnar_file_columns,
+)
+
 
 logger = logging.getLogger(__name__)
 
 
+# Max bytes read from an upload to validate the CSV header
+CSV_VALIDATION_SAMPLE_SIZE = 64 * 1024
+
+
 def file_upload_to(instance, filename):
     date_str = timezone.now().strftime('%Y-%m-%d-%H-%M-%S')
     return f'csv-files/{date_str}/{filename}'
 
 
-def csv_file_validator(document, required_headers):
-    # TODO: Fix import maybe use utils.py
-    from .tasks import format_column
+def get_file_checksum(file):
+    # Streamed, file is never loaded fully into memory
+    file_hash = hashlib.sha256()
+    for chunk in file.chunks():
+        file_hash.update(chunk)
+    file.seek(0)
+    return file_hash.hexdigest()
 
-    try:
-        dialect = csv.Sniffer().sniff(document.readline().decode('utf-8'))
-        document.seek(0, 0)
-        reader = csv.reader(document.read().decode('utf-8').splitlines(), dialect)
-    except (csv.Error, UnicodeDecodeError):
-        raise ValidationError(_('Not a valid CSV file'))
-    for index, row in enumerate(reader):
-        # check that all headers are present
-        if index == 0:
-            csv_headers = [
-                format_column(header_name)
-                for header_name in row
-                if header_name
-            ]
-            missing_headers = set(required_headers) - set(csv_headers)
-            additional_headers = set(csv_headers) - set(required_headers)
-            error_messages = []
-            if missing_headers:
-                _headers = ', '.join(missing_headers)
-                error_messages.append(_('Missing headers: %s' % (_headers)))
-            if additional_headers:
-                _headers = ', '.join(additional_headers)
-                error_messages.append(_('Additional headers: %s' % (_headers)))
-            if error_messages:
-                error_messages.append(
-                    _(
-                        'NOTE: In backend, columns are lowercased and spaces are replaced with _. '
-                        'Eg: Age info -> age_info'
-                    )
-                )
-                raise ValidationError(error_messages)
+
+def read_csv_header_sample(document, sample_size=CSV_VALIDATION_SAMPLE_SIZE, read_size=8 * 1024):
+    """
+    Incrementally decode the start of document until the first line is complete.
+    At most sample_size bytes are read, so the cost doesn't depend on file size.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    sample = ''
+    read_bytes = 0
+    document.seek(0, 0)
+    while read_bytes < sample_size:
+        chunk = document.read(min(read_size, sample_size - read_bytes))
+        if not chunk:
+            sample += decoder.decode(b'', final=True)
+            break
+        read_bytes += len(chunk)
+        sample += decoder.decode(chunk)
+        if '\n' in sample:
             break
     document.seek(0, 0)
+    return sample
+
+
+def headers_validator(headers, required_headers):
+    # check that all headers are present
+    csv_headers = [
+        format_column(header_name)
+        for header_name in headers
+        if header_name
+    ]
+    missing_headers = set(required_headers) - set(csv_headers)
+    additional_headers = set(csv_headers) - set(required_headers)
+    error_messages = []
+    if missing_headers:
+        _headers = ', '.join(missing_headers)
+        error_messages.append(_('Missing headers: %s' % (_headers)))
+    if additional_headers:
+        _headers = ', '.join(additional_headers)
+        error_messages.append(_('Additional headers: %s' % (_headers)))
+    if error_messages:
+        error_messages.append(
+            _(
+                'NOTE: In backend, columns are lowercased and spaces are replaced with _. '
+                'Eg: Age info -> age_info'
+            )
+        )
+        raise ValidationError(error_messages)
     return True
 
 
+def csv_file_validator(document, required_headers):
+    try:
+        # Compressed uploads are decompressed as a stream (only the start is read)
+        with open_csv_stream(document) as stream:
+            header_line = (read_csv_header_sample(stream).splitlines() or [''])[0]
+        dialect = csv.Sniffer().sniff(header_line)
+        header_row = next(csv.reader([header_line], dialect), [])
+    except (csv.Error, UnicodeDecodeError, *FILE_READ_ERRORS):
+        raise ValidationError(_('Not a valid CSV file'))
+    return headers_validator(header_row, required_headers)
+
+
+def columnar_file_validator(document, file_format, required_headers):
+    # Only the schema is read
+    try:
+        headers = read_columnar_file_columns(document, file_format)
+    except pa.ArrowException:
+        raise ValidationError(_('Not a valid %s file') % file_format)
+    return headers_validator(headers, required_headers)
+
+
 class DataImportPreviewBase(models.Model):
     CSV_HEADERS = []
+    # Low-cardinality columns, loaded as pandas categorical
+    CSV_CATEGORICAL_HEADERS = []
     DATA_DB_TABLE_NAME = None
     DATA_DB_COLUMN_MAP = {}
 
@@ -118,6 +178,13 @@ class ImportUserDataPreview(DataImportPreviewBase):
         'thematic',
         'subindicator',
     ]
+    CSV_CATEGORICAL_HEADERS = [
+        'outbreak',
+        'country',
+        'iso3',
+        'gender',
+        'age_group',
+    ]
 
     # WIP: Database meta
     DATA_DB_TABLE_NAME = 'indicator_data'
@@ -140,11 +207,11 @@ class ImportUserDataPreview(DataImportPreviewBase):
         'limitation': 'limitation',
         'nominator': 'nominator',
         'outbreak': None,
-        'percentage': None,
+        'percentage': 'indicator_value',
         'questions': 'question',
         'representativeness': 'representativeness',
         'source_id': 'source_id',
-        'subindicator': None,
+        'subindicator': 'subvariable',
         'target_group': 'target_group',
         'thematic': None,
         'topic': None,
@@ -154,10 +221,8 @@ class ImportUserDataPreview(DataImportPreviewBase):
         # - indicator_comment
         # - indicator_date
         # - indicator_matching
-        # - indicator_value
         # - interpolated
         # - publish
-        # - subvariable
     }
 
     source_id = models.CharField(max_length=255, blank=True, verbose_name=_('Source id'))
@@ -211,6 +276,12 @@ class ImportUserSourceDataPreview(DataImportPreviewBase):
         'source_date',
         'key_words',
     ]
+    CSV_CATEGORICAL_HEADERS = [
+        'sample_type',
+        'scale',
+        'quality_check',
+        'data_access_type',
+    ]
 
     # WIP: Database meta
     DATA_DB_TABLE_NAME = 'sources'
@@ -278,6 +349,7 @@ class DataImport(models.Model):
         PREVIEW = 2, _('Preview')
         MIGRATED = 3, _('Migrated')
         CANCELED = 4, _('Canceled')
+        MIGRATING = 5, _('Migrating')
         # Failed status
         FAILED_PROCESSING = 500, _('Failed Processing')
         FAILED_MIGRATING = 501, _('Failed Migrating')
@@ -297,11 +369,33 @@ class DataImport(models.Model):
         Status.FAILED_PROCESSING,
     ]
 
+    # Previews are being written (or are partially published), these imports can't be canceled or deleted
+    IN_USE_STATUS = [
+        Status.PROCESSING,
+        Status.MIGRATING,
+        Status.FAILED_MIGRATING,
+    ]
+
     file = models.FileField(verbose_name=_('CSV file'), upload_to=file_upload_to)
-    # TODO: Maybe add checksum as well to avoid uploading same file twice.
+    # SHA-256 of file content, used to skip processing of same file twice.
+    checksum = models.CharField(max_length=64, blank=True, db_index=True)
     file_type = models.SmallIntegerField(choices=FileType.choices)
     status = models.SmallIntegerField(choices=Status.choices, default=Status.PENDING)
     description = models.TextField(blank=True, verbose_name=_('Description'))
+    # Processing progress (watermark), used to resume failed processing
+    parsed_rows = models.PositiveIntegerField(default=0)
+    inserted_rows = models.PositiveIntegerField(default=0)
+    last_committed_chunk = models.PositiveIntegerField(null=True, blank=True)
+    # Previews were edited or deleted by reviewers, they no longer match the file (not re-used for duplicates)
+    previews_modified = models.BooleanField(default=False)
+    # Preview counters (denormalized), kept in sync by ingestion and review actions
+    total_rows = models.PositiveIntegerField(default=0)
+    reviewed_rows = models.PositiveIntegerField(default=0)
+    outlier_rows = models.PositiveIntegerField(default=0)
+    # Per-stage durations, row counts and peak memory, see ImportMetrics
+    metrics = models.JSONField(default=dict, blank=True)
+    # Used for admission control of heavy imports
+    estimated_memory_mb = models.PositiveIntegerField(null=True, blank=True)
 
     # Creation
     created_by = models.ForeignKey(
@@ -343,6 +437,11 @@ class DataImport(models.Model):
         on_delete=models.SET_NULL
     )
     migrated_at = models.DateTimeField(verbose_name=_('Migrated at'), null=True, blank=True)
+    # Checkpoint: Previews up to this id are already written to the production database
+    last_migrated_preview_id = models.BigIntegerField(null=True, blank=True)
+    # Batch in flight: production transaction id and its last preview id, resolved when a migration resumes
+    migrating_transaction_id = models.BigIntegerField(null=True, blank=True)
+    migrating_preview_id = models.BigIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.file.name.split('/')[-1]
@@ -351,23 +450,99 @@ class DataImport(models.Model):
     def preview_model(self):
         return self.FILE_TYPE_TO_MODEL_MAP[DataImport.FileType(self.file_type)]
 
+    @property
+    def is_heavy(self):
+        return (self.estimated_memory_mb or 0) >= settings.IMPORT_HEAVY_MEMORY_THRESHOLD_MB
+
+    @classmethod
+    def update_preview_counters(cls, pks):
+        """
+        Recount preview counters of the given imports, one UPDATE per file type.
+        """
+        def _count(PREVIEW_MODEL, **filters):
+            return models.functions.Coalesce(
+                models.Subquery(
+                    PREVIEW_MODEL.objects.filter(
+                        importer=models.OuterRef('pk'),
+                        **filters,
+                    ).values('importer').order_by().annotate(
+                        count=models.Count('id'),
+                    ).values('count')[:1], output_field=models.IntegerField()
+                ), 0
+            )
+
+        for file_type, PREVIEW_MODEL in cls.FILE_TYPE_TO_MODEL_MAP.items():
+            cls.objects.filter(pk__in=pks, file_type=file_type).update(
+                total_rows=_count(PREVIEW_MODEL),
+                reviewed_rows=_count(PREVIEW_MODEL, is_reviewed=True),
+                outlier_rows=_count(PREVIEW_MODEL, no_outlier=False),
+            )
+
+    def get_processed_duplicate(self):
+        """
+        Return existing import with same file content and file type which already has previews.
+        Imports with previews modified by reviewers are skipped, their previews differ from the file.
+        """
+        if not self.checksum:
+            return
+        return DataImport.objects.filter(
+            checksum=self.checksum,
+            file_type=self.file_type,
+            status__in=[
+                DataImport.Status.PREVIEW,
+                DataImport.Status.MIGRATED,
+            ],
+            previews_modified=False,
+        ).exclude(pk=self.pk).order_by('-pk').first()
+
     def clean(self):
+        from .tasks import estimate_data_import_memory_mb
         if self.pk is None and self.file_type is not None and self.file.name:
-            # Validate CSV File on creation.
+            # Validate File on creation.
             required_headers = self.preview_model.CSV_HEADERS
-            csv_file_validator(self.file, required_headers)
+            file_format = get_file_format(self.file.name)
+            metrics = ImportMetrics(self.metrics)
+            with metrics.stage('validate'):
+                if file_format in FileFormat.COLUMNAR:
+                    columnar_file_validator(self.file, file_format, required_headers)
+                else:
+                    csv_file_validator(self.file, required_headers)
+                # Validators only read the start of the file, the estimate reads a larger sample
+                # (and the whole file for small compressed uploads)
+                try:
+                    self.estimated_memory_mb = estimate_data_import_memory_mb(self)
+                except FILE_READ_ERRORS:
+                    raise ValidationError(_('File is damaged or incomplete'))
+            self.metrics = metrics.as_dict()
 
     def save(self, *args, **kwargs):
-        from .tasks import process_data_import
+        from .tasks import estimate_data_import_memory_mb, fail_data_import, get_data_import_queue, process_data_import
         new = False
         if self.pk is None:
             new = True
+            if self.file and self.estimated_memory_mb is None:
+                try:
+                    self.estimated_memory_mb = estimate_data_import_memory_mb(self)
+                except FILE_READ_ERRORS:
+                    # Not validated (clean() is not used), processing retries and fails the import
+                    logger.warning('Failed to estimate the memory of a new DataImport', exc_info=True)
         super().save(*args, **kwargs)
         if new:
+            create_preview_partition(self.preview_model, self.pk)
             transaction.on_commit(
-                lambda: process_data_import.delay(self.pk)
+                lambda: process_data_import.apply_async(
+                    (self.pk,),
+                    queue=get_data_import_queue(self),
+                    link_error=fail_data_import.s(self.pk),
+                )
             )
 
+    def delete(self, *args, **kwargs):
+        # Previews are removed with a partition drop instead of a row by row cascade
+        with transaction.atomic():
+            drop_preview_partition(self.preview_model, self.pk)
+            return super().delete(*args, **kwargs)
+
 
 class CachedCountryFilterOptions(models.Model):
     iso3 = models.CharField(max_length=3)
@@ -382,3 +557,27 @@ class CachedCountryFilterOptions(models.Model):
 
     def __str__(self):
         return self.iso3
+
+
+class IndicatorDataOutlierBaseline(models.Model):
+    """
+    Precomputed indicator_data distribution per (indicator_id, subvariable), used for outlier detection.
+    Refreshed periodically, see outlier_detect.update_outlier_baselines
+    """
+    indicator_id = models.CharField(max_length=255)
+    subvariable = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+    mean = models.FloatField(null=True, blank=True)
+    # Sum of squared deviations from the mean (variance = m2 / count)
+    m2 = models.FloatField(null=True, blank=True)
+    # Quantile -> value. Eg: {"0.25": 10.2, "0.5": 12.1, "0.75": 15}
+    quantiles = models.JSONField(default=dict, blank=True)
+    # Median absolute deviation
+    mad = models.FloatField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('indicator_id', 'subvariable')
+
+    def __str__(self):
+        return f'{self.indicator_id} - {self.subvariable}'
@@ -1,65 +1,360 @@
-from typing import NamedTuple, Tuple, List
+from typing import Callable, NamedTuple, Optional, List, Union
 
+import numpy as np
+import pandas as pd
+from django.db import connections, router, transaction
 from django.db.models import Avg
-from django.db.models.aggregates import StdDev
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
 
 from apps.data.models import IndicatorData
 
-from .models import ImportUserDataPreview
+from .metrics import ImportMetrics
+from .readers import read_data_import_column_values
+from .models import (
+    ImportUserDataPreview,
+    ImportUserSourceDataPreview,
+    IndicatorDataOutlierBaseline,
+)
+
+Value = Union[float, pd.Series]
 
 
 class OutlierCompareData(NamedTuple):
-    mean: float
-    std: float
-
-
-def get_outlier_compare_data_for_indicator_data() -> dict[str, OutlierCompareData]:
-    return dict(
-        percentage=OutlierCompareData(
-            **IndicatorData.objects.aggregate(
-                # https://docs.djangoproject.com/en/4.1/ref/models/querysets/#avg
-                mean=Avg('indicator_value'),
-                # https://docs.djangoproject.com/en/4.1/ref/models/querysets/#stddev
-                std=StdDev('indicator_value'),
+    # Scalar or per row values (Series aligned with the DataFrame)
+    mean: Value
+    std: Value
+    median: Optional[Value] = None
+    # Median absolute deviation
+    mad: Optional[Value] = None
+    # Quartiles
+    q1: Optional[Value] = None
+    q3: Optional[Value] = None
+    # Most recent value (time series)
+    last: Optional[Value] = None
+
+
+class OutlierResult(NamedTuple):
+    columns: List[str]
+    # Row x Column boolean matrix (in df order), True for outliers
+    mask: np.ndarray
+
+    @property
+    def rows(self) -> np.ndarray:
+        # Row mask, True if any column of the row is an outlier
+        return self.mask.any(axis=1)
+
+
+class OutlierDetector(NamedTuple):
+    # (df) -> OutlierCompareData, (values) -> OutlierCompareData for from_upload detectors
+    compare_data: Callable
+    # (values, compare data) -> boolean Series (True for outliers)
+    detect: Callable
+    # Compare data comes from the column values of the whole upload (see get_upload_compare_data),
+    # so that results don't depend on how the upload is split into chunks and parts
+    from_upload: bool = False
+
+
+# Months of history used by the time series check
+OUTLIER_HISTORY_MONTHS = 6
+# Series with fewer months of history are not scored
+OUTLIER_HISTORY_MIN_MONTHS = 3
+# Preview columns splitting an indicator into separate series (rows are compared with the same disaggregation)
+OUTLIER_HISTORY_DISAGGREGATION_COLUMNS = ['adminlevel1', 'area', 'gender', 'age_group', 'target_group']
+# Relative change from the most recent month which is flagged (0.4 -> 40%)
+OUTLIER_HISTORY_MAX_RELATIVE_CHANGE = 0.4
+
+
+# Quantiles stored in IndicatorDataOutlierBaseline.quantiles
+OUTLIER_BASELINE_QUANTILES = [0.25, 0.5, 0.75]
+
+
+def update_outlier_baselines():
+    """
+    Recompute IndicatorDataOutlierBaseline from indicator_data (run periodically).
+    """
+    connection = connections[router.db_for_read(IndicatorData)]
+    qn = connection.ops.quote_name
+    table = qn(IndicatorData._meta.db_table)
+    indicator_id, subvariable, value = qn('indicator_id'), qn('subvariable'), qn('indicator_value')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH stats AS (
+                SELECT
+                    {indicator_id},
+                    {subvariable},
+                    COUNT({value}) AS count,
+                    AVG({value}) AS mean,
+                    VAR_POP({value}) * COUNT({value}) AS m2,
+                    PERCENTILE_CONT(%s::float[]) WITHIN GROUP (ORDER BY {value}) AS quantiles,
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY {value}) AS median
+                FROM {table}
+                WHERE {value} IS NOT NULL
+                GROUP BY 1, 2
             )
+            SELECT
+                stats.{indicator_id},
+                stats.{subvariable},
+                stats.count,
+                stats.mean,
+                stats.m2,
+                stats.quantiles,
+                PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY ABS(data.{value} - stats.median))
+            FROM stats
+                INNER JOIN {table} AS data ON (
+                    data.{indicator_id} = stats.{indicator_id} AND
+                    data.{subvariable} = stats.{subvariable} AND
+                    data.{value} IS NOT NULL
+                )
+            GROUP BY 1, 2, 3, 4, 5, 6
+            """,
+            [OUTLIER_BASELINE_QUANTILES],
         )
+        new_baselines = [
+            IndicatorDataOutlierBaseline(
+                indicator_id=indicator_id,
+                subvariable=subvariable,
+                count=count,
+                mean=mean,
+                m2=m2,
+                quantiles=dict(zip(map(str, OUTLIER_BASELINE_QUANTILES), quantiles)),
+                mad=mad,
+            )
+            for indicator_id, subvariable, count, mean, m2, quantiles, mad in cursor.fetchall()
+        ]
+    with transaction.atomic():
+        # Remove old baselines
+        IndicatorDataOutlierBaseline.objects.all().delete()
+        IndicatorDataOutlierBaseline.objects.bulk_create(new_baselines)
+    return len(new_baselines)
+
+
+def get_outlier_compare_data_for_indicator_data(df) -> OutlierCompareData:
+    """
+    Baseline per (indicator_id, subvariable) from the precomputed IndicatorDataOutlierBaseline,
+    limited to the indicator ids in df. Uploaded subindicator is compared with subvariable.
+    """
+    keys = df[['indicator_id', 'subindicator']].astype(object)
+    baseline_df = pd.DataFrame.from_records(
+        IndicatorDataOutlierBaseline.objects.filter(
+            indicator_id__in=keys['indicator_id'].dropna().unique().tolist(),
+        ).values('indicator_id', 'subvariable', 'count', 'mean', 'm2', 'mad', 'quantiles'),
+        columns=['indicator_id', 'subvariable', 'count', 'mean', 'm2', 'mad', 'quantiles'],
+    )
+    # Population standard deviation
+    baseline_df['std'] = np.sqrt(baseline_df['m2'].astype(float) / baseline_df['count'].replace(0, np.nan))
+    for column, quantile in [('q1', '0.25'), ('median', '0.5'), ('q3', '0.75')]:
+        # NOTE: map (instead of a DataFrame of the records) also works without baselines
+        baseline_df[column] = baseline_df['quantiles'].map(
+            lambda quantiles: (quantiles or {}).get(quantile),
+        )
+    # Left join keeps the row order, rows without baseline get NaN (not scored)
+    compare_df = keys.merge(
+        baseline_df,
+        how='left',
+        left_on=['indicator_id', 'subindicator'],
+        right_on=['indicator_id', 'subvariable'],
+    ).set_index(df.index)
+    return OutlierCompareData(
+        mean=compare_df['mean'].astype(float),
+        std=compare_df['std'].astype(float),
+        median=compare_df['median'].astype(float),
+        mad=compare_df['mad'].astype(float),
+        q1=compare_df['q1'].astype(float),
+        q3=compare_df['q3'].astype(float),
     )
 
 
-OUTLIER_COMPARE_DATA_GENERATOR = {
-    ImportUserDataPreview: get_outlier_compare_data_for_indicator_data
-}
+def get_history_columns():
+    # Preview column -> indicator_data column of the series keys
+    return {
+        'iso3': 'iso3',
+        'indicator_id': 'indicator_id',
+        'subindicator': 'subvariable',
+        **{
+            column: ImportUserDataPreview.DATA_DB_COLUMN_MAP[column]
+            for column in OUTLIER_HISTORY_DISAGGREGATION_COLUMNS
+        },
+    }
+
+
+def get_indicator_data_history(keys) -> pd.DataFrame:
+    """
+    Monthly average values of the recent indicator_data for the keys (indicator_data columns), using one query.
+    """
+    history_columns = list(get_history_columns().values())
+    return pd.DataFrame.from_records(
+        IndicatorData.objects.filter(
+            iso3__in=keys['iso3'].unique().tolist(),
+            indicator_id__in=keys['indicator_id'].unique().tolist(),
+            subvariable__in=keys['subvariable'].unique().tolist(),
+            insert_date__gte=(pd.Timestamp(timezone.now().date()) - pd.DateOffset(months=OUTLIER_HISTORY_MONTHS)).date(),
+            indicator_value__isnull=False,
+        ).annotate(
+            month=TruncMonth('insert_date'),
+        ).values(*history_columns, 'month').order_by().annotate(
+            value=Avg('indicator_value'),
+        ),
+        columns=[*history_columns, 'month', 'value'],
+    )
 
 
-def detect_outliers(
-    df,
-    model,
+def get_outlier_compare_data_from_history(df, history_df=None) -> OutlierCompareData:
+    """
+    Recent monthly series per (iso3, indicator_id, subvariable) and disaggregation for the keys in df.
+    Series with less than OUTLIER_HISTORY_MIN_MONTHS months are not used.
+    history_df: see get_indicator_data_history, default: loaded for the keys in df
+    """
+    column_map = get_history_columns()
+    history_columns = list(column_map.values())
+    # Missing disaggregation is empty text in previews and empty or NULL in indicator_data
+    keys = df[list(column_map.keys())].astype(object).fillna('').rename(columns=column_map)
+    if history_df is None:
+        history_df = get_indicator_data_history(keys)
+    history_df = history_df.copy()
+    history_df[history_columns] = history_df[history_columns].fillna('')
+    history_df['value'] = history_df['value'].astype(float)
+    # Merge NULL and empty disaggregation series
+    history_df = history_df.groupby([*history_columns, 'month'], as_index=False)['value'].mean()
+    series_df = history_df.sort_values('month').groupby(history_columns)['value'].agg(
+        mean='mean',
+        std='std',
+        last='last',
+        months='count',
+    ).reset_index()
+    series_df = series_df[series_df['months'] >= OUTLIER_HISTORY_MIN_MONTHS]
+    # Left join keeps the row order, rows without history get NaN (not scored)
+    compare_df = keys.merge(
+        series_df,
+        how='left',
+        on=history_columns,
+    ).set_index(df.index)
+    return OutlierCompareData(
+        mean=compare_df['mean'].astype(float),
+        std=compare_df['std'].astype(float),
+        last=compare_df['last'].astype(float),
+    )
+
+
+def get_outlier_compare_data_from_upload(values) -> OutlierCompareData:
+    """
+    Baseline from the uploaded values itself (for columns without production data to compare with)
+    """
+    values = pd.Series(values, dtype=float)
+    median = values.median()
+    q1, q3 = values.quantile([0.25, 0.75])
+    return OutlierCompareData(
+        mean=values.mean(),
+        std=values.std(ddof=0),
+        median=median,
+        mad=(values - median).abs().median(),
+        q1=q1,
+        q3=q3,
+    )
+
+
+# -- Detectors
+def z_score_detector(values, compare_data: OutlierCompareData, threshold=3):
+    std = compare_data.std
+    std = std.where(std > 0, 0.1) if isinstance(std, pd.Series) else (std or 0.1)
+    return ((values - compare_data.mean) / std).abs() > threshold
+
+
+def mad_detector(values, compare_data: OutlierCompareData, threshold=3.5):
+    """
+    Modified z-score (Iglewicz and Hoaglin), robust to skewed data.
+    """
+    mad = compare_data.mad
+    # Not scored when there is no spread
+    mad = mad.where(mad > 0) if isinstance(mad, pd.Series) else (mad or np.nan)
+    return (0.6745 * (values - compare_data.median) / mad).abs() > threshold
+
+
+def iqr_detector(values, compare_data: OutlierCompareData, k=1.5):
+    """
+    Tukey's fences
+    """
+    iqr = compare_data.q3 - compare_data.q1
+    return (values < compare_data.q1 - k * iqr) | (values > compare_data.q3 + k * iqr)
+
+
+def history_detector(
+    values,
+    compare_data: OutlierCompareData,
     threshold=3,
-) -> Tuple[dict, List[int]]:
-    def flatten(array):
-        return [
-            item for sublist in array for item in sublist
-        ]
-    outlier_col_indices = {}
-    list_of_indices = []
-    if model in OUTLIER_COMPARE_DATA_GENERATOR:
-        columns_meta = OUTLIER_COMPARE_DATA_GENERATOR[model]()
-        for col, agg in columns_meta.items():
-            df[f"z_score_{col}"] = (df[col] - agg.mean) / (agg.std or 0.1)
-        for col in columns_meta.keys():
-            outlier_col_indices[col] = set(
-                df[
-                    (df[f"z_score_{col}"] > threshold) | (df[f"z_score_{col}"] < -threshold)
-                ].index
-            )
-        list_of_indices = list(
-            set(
-                flatten(
-                    list(
-                        outlier_col_indices.values()
-                    )
+    max_relative_change=OUTLIER_HISTORY_MAX_RELATIVE_CHANGE,
+):
+    """
+    Flag jumps from the most recent month and deviations from the recent series.
+    """
+    last = compare_data.last.where(compare_data.last != 0)
+    is_jump = ((values - compare_data.last) / last).abs() > max_relative_change
+    std = compare_data.std.where(compare_data.std > 0)
+    is_deviation = ((values - compare_data.mean) / std).abs() > threshold
+    return is_jump | is_deviation
+
+
+# Model -> Column -> Detectors (a column is an outlier if any of the detectors flags it)
+OUTLIER_DETECTORS: dict[type, dict[str, List[OutlierDetector]]] = {
+    ImportUserDataPreview: {
+        'percentage': [
+            OutlierDetector(get_outlier_compare_data_for_indicator_data, mad_detector),
+            OutlierDetector(get_outlier_compare_data_from_history, history_detector),
+        ],
+    },
+    ImportUserSourceDataPreview: {
+        'sample': [
+            OutlierDetector(get_outlier_compare_data_from_upload, iqr_detector, from_upload=True),
+        ],
+    },
+}
+
+
+def get_upload_compare_data(data_import) -> dict:
+    """
+    Compare data of the from_upload detectors of the import, computed once from the whole upload.
+    Return column -> OutlierCompareData as dict (JSON serializable, passed to the parts tasks).
+    """
+    return {
+        column: {
+            key: float(value)
+            for key, value in detector.compare_data(read_data_import_column_values(data_import, column))._asdict().items()
+            if value is not None
+        }
+        for column, detectors in OUTLIER_DETECTORS.get(data_import.preview_model, {}).items()
+        for detector in detectors
+        if detector.from_upload
+    }
+
+
+def detect_outliers(df, model, metrics=None, upload_compare_data=None) -> OutlierResult:
+    """
+    Run the registered detectors of model on df.
+    Detector results of the same column are ORed together.
+    upload_compare_data: see get_upload_compare_data, default: computed from df (if df is the whole upload)
+    Time spent loading compare data and scoring is added to metrics.
+    """
+    metrics = metrics or ImportMetrics()
+    columns = []
+    column_masks = []
+    for col, detectors in OUTLIER_DETECTORS.get(model, {}).items():
+        values = df[col].astype(float)
+        detector_masks = []
+        for detector in detectors:
+            with metrics.stage('outlier_compare_data'):
+                if not detector.from_upload:
+                    compare_data = detector.compare_data(df)
+                elif upload_compare_data is not None:
+                    compare_data = OutlierCompareData(**upload_compare_data[col])
+                else:
+                    compare_data = detector.compare_data(values)
+            with metrics.stage('outlier_scoring'):
+                detector_masks.append(
+                    detector.detect(values, compare_data).fillna(False).to_numpy(dtype=bool)
                 )
-            )
-        )
-        return outlier_col_indices, list_of_indices
-    return outlier_col_indices, list_of_indices
+        columns.append(col)
+        column_masks.append(np.logical_or.reduce(detector_masks))
+    if not columns:
+        return OutlierResult(columns, np.zeros((len(df), 0), dtype=bool))
+    return OutlierResult(columns, np.column_stack(column_masks))
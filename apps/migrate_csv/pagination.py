@@ -0,0 +1,67 @@
+import json
+
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# Result sets estimated larger than this (by the query planner) are not counted exactly
+ESTIMATED_COUNT_THRESHOLD = 10000
+# GET parameter used for keyset pagination (also a valid changelist lookup)
+KEYSET_VAR = 'id__lt'
+
+
+def get_estimated_count(queryset):
+    """
+    Return row count estimated by the postgres query planner, None for other databases.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class EstimatedCountPaginator(Paginator):
+    is_estimated = False
+
+    @cached_property
+    def count(self):
+        estimated_count = get_estimated_count(self.object_list)
+        if estimated_count is None or estimated_count < ESTIMATED_COUNT_THRESHOLD:
+            return super().count
+        self.is_estimated = True
+        return estimated_count
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList paginated by id (descending) instead of OFFSET.
+    Next page is fetched with id__lt=<last id of current page>.
+    Custom ordering (sorted columns) falls back to the default pagination.
+    """
+    def get_results(self, request):
+        self.keyset_pagination = ORDER_VAR not in self.params
+        if self.keyset_pagination:
+            # Rows of the next pages are selected using KEYSET_VAR lookup, always the first page.
+            self.page_num = 1
+        super().get_results(request)
+        self.next_keyset_id = None
+        if self.keyset_pagination and self.multi_page and not self.show_all:
+            result_list = list(self.result_list)
+            if len(result_list) == self.list_per_page:
+                self.next_keyset_id = result_list[-1].pk
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string(remove=[KEYSET_VAR, PAGE_VAR])
+
+    @property
+    def next_page_url(self):
+        if self.next_keyset_id is not None:
+            return self.get_query_string({KEYSET_VAR: self.next_keyset_id}, remove=[PAGE_VAR])
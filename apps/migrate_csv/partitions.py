@@ -0,0 +1,89 @@
+"""
+Preview tables are LIST partitioned by importer_id on postgres (see migration 0015).
+Each DataImport gets its own partition, so its previews are removed with a DROP TABLE
+and queries filtered on importer only scan one partition.
+"""
+from django.db import connections, router
+
+
+def get_preview_partition_name(model, importer_id):
+    return f'{model._meta.db_table}_p{importer_id}'
+
+
+def get_preview_default_partition_name(model):
+    return f'{model._meta.db_table}_default'
+
+
+def _get_partitioned_connection(model):
+    """
+    Return connection if the model table is partitioned, None otherwise (other databases, not migrated).
+    """
+    connection = connections[router.db_for_write(model)]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+            [model._meta.db_table],
+        )
+        if cursor.fetchone():
+            return connection
+
+
+def _get_preview_partition(model, importer_id):
+    connection = _get_partitioned_connection(model)
+    if connection is None:
+        return None, None
+    partition = get_preview_partition_name(model, importer_id)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [partition])
+        exists = cursor.fetchone()[0] is not None
+    return connection, exists and partition
+
+
+def create_preview_partition(model, importer_id):
+    """
+    Create an empty partition for importer_id.
+    The table is created first and then attached, which only needs a SHARE UPDATE EXCLUSIVE lock
+    on the parent table (CREATE TABLE .. PARTITION OF blocks concurrent imports).
+    """
+    connection, partition = _get_preview_partition(model, importer_id)
+    if connection is None or partition:
+        return False
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    partition = qn(get_preview_partition_name(model, importer_id))
+    importer_column = qn(model._meta.get_field('importer').column)
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS)')
+        # Skips the validation scan on attach
+        cursor.execute(
+            f'ALTER TABLE {partition} ADD CHECK ({importer_column} IS NOT NULL AND {importer_column} = %s)',
+            [importer_id],
+        )
+        cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES IN (%s)', [importer_id])
+    return True
+
+
+def drop_preview_partition(model, importer_id):
+    """
+    Drop partition (and all previews) of importer_id, return False if there is no partition.
+    """
+    connection, partition = _get_preview_partition(model, importer_id)
+    if not partition:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE {connection.ops.quote_name(partition)}')
+    return True
+
+
+def truncate_preview_partition(model, importer_id):
+    """
+    Remove all previews of importer_id, return False if there is no partition.
+    """
+    connection, partition = _get_preview_partition(model, importer_id)
+    if not partition:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(f'TRUNCATE TABLE {connection.ops.quote_name(partition)}')
+    return True
@@ -0,0 +1,552 @@
+import gzip
+import os
+import zipfile
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from django.db import models
+from pyarrow import csv as pa_csv
+from pyarrow import parquet as pa_parquet
+
+# Number of CSV rows loaded into memory at once
+IMPORT_CHUNK_SIZE = 10000
+# Uploads larger than this (in bytes) are parsed with the multi-threaded pyarrow reader
+IMPORT_ARROW_FILE_SIZE_THRESHOLD = 20 * 1024 * 1024
+# Bytes of CSV parsed by pyarrow per record batch (rows per chunk depends on this)
+IMPORT_ARROW_BLOCK_SIZE = 4 * 1024 * 1024
+# Bytes of CSV read at once for the pyarrow reader, its record batches are parsed in parallel
+IMPORT_ARROW_READ_SIZE = 8 * IMPORT_ARROW_BLOCK_SIZE
+# Bytes preceding the first character of a CSV field
+CSV_FIELD_START_BYTES = [ord(','), ord('\n')]
+# Bytes of (decompressed) CSV read to estimate the row size of an upload
+IMPORT_ESTIMATE_SAMPLE_SIZE = 1024 * 1024
+# Raised reading damaged or truncated uploads (gzip.BadGzipFile is an OSError)
+FILE_READ_ERRORS = (OSError, EOFError, zlib.error, zipfile.BadZipFile, pa.ArrowException)
+
+
+class FileFormat:
+    CSV = 'csv'
+    PARQUET = 'parquet'
+    FEATHER = 'feather'
+
+    EXTENSION_MAP = {
+        '.parquet': PARQUET,
+        '.feather': FEATHER,
+        '.arrow': FEATHER,
+    }
+    # Typed formats read using pyarrow
+    COLUMNAR = [PARQUET, FEATHER]
+
+
+def get_file_format(file_name):
+    # Anything else is handled as CSV
+    return FileFormat.EXTENSION_MAP.get(os.path.splitext(file_name)[1].lower(), FileFormat.CSV)
+
+
+class FileCompression:
+    GZIP = 'gzip'
+    ZIP = 'zip'
+
+    EXTENSION_MAP = {
+        '.gz': GZIP,
+        '.zip': ZIP,
+    }
+
+
+def get_file_compression(file_name):
+    return FileCompression.EXTENSION_MAP.get(os.path.splitext(file_name)[1].lower())
+
+
+def get_zip_member(archive):
+    members = [
+        member
+        for member in archive.infolist()
+        if not member.is_dir()
+    ]
+    if len(members) != 1:
+        raise zipfile.BadZipFile('Zip file should contain exactly one file')
+    return members[0]
+
+
+@contextmanager
+def open_csv_stream(file):
+    """
+    Yield a file object with the (decompressed) CSV content.
+    Compressed files are decompressed as a stream, nothing is written to disk or kept in memory.
+    Supports .gz and .zip (with a single file)
+    """
+    compression = get_file_compression(file.name)
+    file.seek(0)
+    try:
+        if compression == FileCompression.GZIP:
+            with gzip.GzipFile(fileobj=file, mode='rb') as stream:
+                yield stream
+        elif compression == FileCompression.ZIP:
+            with zipfile.ZipFile(file) as archive:
+                with archive.open(get_zip_member(archive)) as stream:
+                    yield stream
+        else:
+            yield file
+    finally:
+        file.seek(0)
+
+
+def format_column(column):
+    # Lower all columns name
+    return column.lower().replace(' ', '_')
+
+
+def is_pandas_index_column(column):
+    # Index stored by DataFrame.to_parquet/to_feather
+    return column.startswith('__index_level_')
+
+
+def get_preview_model_read_options(model):
+    """
+    pandas dtype/parse_dates options derived from the preview model fields,
+    this avoids type inference (and object columns) while parsing.
+    """
+    dtype = {}
+    parse_dates = []
+    for column in model.CSV_HEADERS:
+        field = model._meta.get_field(column)
+        if isinstance(field, models.DateField):
+            parse_dates.append(column)
+        elif isinstance(field, models.IntegerField):
+            # Nullable integer
+            dtype[column] = 'Int64'
+        elif isinstance(field, models.FloatField):
+            dtype[column] = 'float64'
+        elif column in model.CSV_CATEGORICAL_HEADERS:
+            dtype[column] = 'category'
+        else:
+            dtype[column] = 'string'
+    return dict(dtype=dtype, parse_dates=parse_dates)
+
+
+def read_data_import_columns(data_import):
+    data_import.file.open('rb')
+    try:
+        with open_csv_stream(data_import.file) as stream:
+            return [
+                format_column(column)
+                for column in pd.read_csv(stream, delimiter=',', nrows=0).columns
+            ]
+    finally:
+        data_import.file.close()
+
+
+def get_arrow_column_types(read_options):
+    arrow_types = {
+        'Int64': pa.int64(),
+        'float64': pa.float64(),
+        'string': pa.string(),
+        'category': pa.dictionary(pa.int32(), pa.string()),
+    }
+    return {
+        column: arrow_types[dtype]
+        for column, dtype in read_options['dtype'].items()
+    }
+
+
+def use_arrow_engine(data_import):
+    return (
+        get_file_format(data_import.file.name) == FileFormat.CSV and
+        data_import.file.size >= IMPORT_ARROW_FILE_SIZE_THRESHOLD
+    )
+
+
+def _read_chunks_with_pandas(stream, columns, read_options, chunk_size, skip_rows, nrows):
+    yield from pd.read_csv(
+        stream,
+        delimiter=',',
+        header=0,
+        names=columns,
+        chunksize=chunk_size,
+        # Header is row 0
+        skiprows=(lambda row: 0 < row <= skip_rows) if skip_rows else None,
+        nrows=nrows,
+        **read_options,
+    )
+
+
+def _get_csv_quoted_spans(array, quote_positions):
+    """
+    Return (start, end) offsets arrays of the quoted values, end is len(array) for a value not closed.
+    Quotes alternate between opening and closing (a doubled quote closes and re-opens an empty span),
+    until a stray quote: a quote outside quoted values which doesn't start a field is kept as is.
+    """
+    quote_count = len(quote_positions)
+    previous_bytes = array[quote_positions - 1]
+    is_field_start = quote_positions == 0
+    for field_start_byte in CSV_FIELD_START_BYTES:
+        is_field_start |= previous_bytes == field_start_byte
+    is_doubled = np.zeros(quote_count, dtype=bool)
+    is_doubled[1:] = np.diff(quote_positions) == 1
+    # Quotes which can't be opening, by parity of their index
+    invalid_openings = np.flatnonzero(~(is_field_start | is_doubled))
+    invalid_openings_by_parity = [invalid_openings[invalid_openings % 2 == parity] for parity in (0, 1)]
+    opening_indexes = []
+    index = 0
+    while index < quote_count:
+        if not is_field_start[index]:
+            # Stray quote
+            index += 1
+            continue
+        invalid = invalid_openings_by_parity[index % 2]
+        next_invalid = np.searchsorted(invalid, index)
+        stray_index = invalid[next_invalid] if next_invalid < len(invalid) else quote_count
+        opening_indexes.append(np.arange(index, stray_index, 2))
+        index = stray_index
+    opening_indexes = np.concatenate(opening_indexes) if opening_indexes else np.array([], dtype=np.int64)
+    closing_indexes = opening_indexes + 1
+    ends = np.full(len(opening_indexes), len(array))
+    is_closed = closing_indexes < quote_count
+    ends[is_closed] = quote_positions[closing_indexes[is_closed]]
+    return quote_positions[opening_indexes], ends
+
+
+def get_csv_line_breaks(data):
+    """
+    Return offsets of the line breaks of data (should start with a row) and a mask of those inside quoted values.
+    Like pandas and pyarrow, a quote only starts a quoted value at the start of a field (other quotes are kept
+    as is), and quotes inside quoted values are doubled.
+    """
+    array = np.frombuffer(data, dtype=np.uint8)
+    line_breaks = np.flatnonzero(array == ord('\n'))
+    quote_positions = np.flatnonzero(array == ord('"'))
+    starts, ends = _get_csv_quoted_spans(array, quote_positions) if len(quote_positions) else ([], [])
+    if not len(starts):
+        return line_breaks, np.zeros(len(line_breaks), dtype=bool)
+    # Last quoted value starting before each line break
+    span_index = np.searchsorted(starts, line_breaks) - 1
+    is_quoted = (span_index >= 0) & (line_breaks < ends[span_index.clip(0)])
+    return line_breaks, is_quoted
+
+
+def find_csv_row_boundary(data):
+    """
+    Return end offset of the last complete row of data (0 if there is none), data should start with a row.
+    """
+    line_breaks, is_quoted = get_csv_line_breaks(data)
+    row_ends = line_breaks[~is_quoted]
+    return int(row_ends[-1]) + 1 if len(row_ends) else 0
+
+
+def has_quoted_line_breaks(data):
+    if b'"' not in data:
+        return False
+    return bool(get_csv_line_breaks(data)[1].any())
+
+
+def iter_csv_row_blocks(stream, read_size=IMPORT_ARROW_READ_SIZE, size=None):
+    """
+    Yield the CSV content of stream (from its current position) as blocks of complete rows,
+    of about read_size bytes each.
+    size: Bytes to read (should end at a row boundary), default: until the end
+    """
+    pending = b''
+    while True:
+        data = stream.read(read_size if size is None else min(read_size, size))
+        if not data:
+            break
+        if size is not None:
+            size -= len(data)
+        pending += data
+        end = find_csv_row_boundary(pending)
+        if end:
+            yield pending[:end]
+            pending = pending[end:]
+    if pending.strip():
+        yield pending
+
+
+def read_arrow_csv_block(block, columns, read_options):
+    """
+    Parse a block of complete CSV rows (without header) using the multi-threaded pyarrow reader,
+    IMPORT_ARROW_BLOCK_SIZE parts of the block are parsed in parallel.
+    """
+    return pa_csv.read_csv(
+        pa.BufferReader(block),
+        read_options=pa_csv.ReadOptions(
+            use_threads=True,
+            block_size=IMPORT_ARROW_BLOCK_SIZE,
+            column_names=columns,
+        ),
+        # Slower (less parallel) parsing is only used when needed
+        parse_options=pa_csv.ParseOptions(delimiter=',', newlines_in_values=has_quoted_line_breaks(block)),
+        # Dates are parsed by pandas (pyarrow only supports ISO-8601)
+        convert_options=pa_csv.ConvertOptions(column_types=get_arrow_column_types(read_options)),
+    )
+
+
+def get_csv_row_ranges(stream, part_size):
+    """
+    Return (start, end) byte offsets of consecutive row ranges of about part_size bytes (header excluded).
+    Rows are not parsed, the content is only scanned for line breaks outside quoted values.
+    """
+    start = end = len(stream.readline())
+    row_ranges = []
+    for block in iter_csv_row_blocks(stream, read_size=min(part_size, IMPORT_ARROW_BLOCK_SIZE)):
+        end += len(block)
+        if end - start >= part_size:
+            row_ranges.append((start, end))
+            start = end
+    if end > start:
+        row_ranges.append((start, end))
+    return row_ranges
+
+
+def _read_chunks_with_arrow(stream, columns, read_options, skip_rows, nrows, size=None):
+    """
+    CSV is read IMPORT_ARROW_READ_SIZE bytes at a time (split at row boundaries), each block is parsed
+    with the multi-threaded pyarrow reader and its record batches are yielded as chunks.
+    stream should be positioned after the header (or at the start of a row range of size bytes).
+    """
+    batches = (
+        batch
+        for block in iter_csv_row_blocks(stream, size=size)
+        if block.strip()
+        for batch in read_arrow_csv_block(block, columns, read_options).to_batches()
+    )
+    for batch in _slice_arrow_batches(batches, skip_rows, nrows):
+        yield arrow_batch_to_dataframe(batch, read_options)
+
+
+def _slice_arrow_batches(batches, skip_rows, nrows):
+    remaining_rows = nrows
+    for batch in batches:
+        if skip_rows >= batch.num_rows:
+            skip_rows -= batch.num_rows
+            continue
+        if skip_rows:
+            batch = batch.slice(skip_rows)
+            skip_rows = 0
+        if remaining_rows is not None:
+            if remaining_rows <= 0:
+                break
+            batch = batch.slice(0, remaining_rows)
+            remaining_rows -= batch.num_rows
+        yield batch
+
+
+def arrow_batch_to_dataframe(batch, read_options):
+    df = batch.to_pandas(
+        types_mapper={
+            pa.int64(): pd.Int64Dtype(),
+            pa.string(): pd.StringDtype(),
+        }.get,
+        date_as_object=False,
+    ).rename(columns=format_column)
+    for column in read_options['parse_dates']:
+        if not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column])
+    # Typed files can still use other types (eg: int32, non-dictionary strings)
+    mismatched_dtype = {
+        column: dtype
+        for column, dtype in read_options['dtype'].items()
+        if str(df[column].dtype) != dtype
+    }
+    if mismatched_dtype:
+        df = df.astype(mismatched_dtype)
+    return df
+
+
+def read_columnar_file_columns(file, file_format):
+    """
+    Column names from the file schema (rows are not read)
+    """
+    file.seek(0)
+    if file_format == FileFormat.PARQUET:
+        schema = pa_parquet.read_schema(file)
+    else:
+        schema = pa.ipc.open_file(file).schema
+    file.seek(0)
+    return [
+        column
+        for column in schema.names
+        if not is_pandas_index_column(column)
+    ]
+
+
+def _get_columnar_file_batches(file, file_format, chunk_size, record_batches=None):
+    if file_format == FileFormat.PARQUET:
+        parquet_file = pa_parquet.ParquetFile(file)
+        yield from parquet_file.iter_batches(
+            batch_size=chunk_size,
+            columns=[
+                column
+                for column in parquet_file.schema_arrow.names
+                if not is_pandas_index_column(column)
+            ],
+        )
+    else:
+        reader = pa.ipc.open_file(file)
+        for index in range(*(record_batches or (0, reader.num_record_batches))):
+            yield reader.get_batch(index)
+
+
+def _read_chunks_from_columnar_file(
+    data_import, file_format, read_options, chunk_size, skip_rows, nrows, record_batches,
+):
+    for batch in _slice_arrow_batches(
+        _get_columnar_file_batches(data_import.file, file_format, chunk_size, record_batches),
+        skip_rows,
+        nrows,
+    ):
+        yield arrow_batch_to_dataframe(batch, read_options)
+
+
+def read_data_import_chunks(
+    data_import, chunk_size=IMPORT_CHUNK_SIZE, skip_rows=0, nrows=None, byte_range=None, record_batches=None,
+):
+    """
+    Yield the uploaded file as DataFrames of at most chunk_size rows
+    (IMPORT_ARROW_BLOCK_SIZE bytes of CSV when using pyarrow CSV reader, a record batch of Feather files).
+    skip_rows/nrows: Row range to read (header is always used)
+    byte_range: (start, end) offsets of the (decompressed) CSV rows to read, see get_csv_row_ranges
+    record_batches: (start, stop) indexes of the Feather record batches to read
+    """
+    file_format = get_file_format(data_import.file.name)
+    read_options = get_preview_model_read_options(data_import.preview_model)
+    if file_format in FileFormat.COLUMNAR:
+        data_import.file.open('rb')
+        try:
+            yield from _read_chunks_from_columnar_file(
+                data_import, file_format, read_options, chunk_size, skip_rows, nrows, record_batches,
+            )
+        finally:
+            data_import.file.close()
+        return
+
+    # Use formatted column names directly, so that read options can be defined using those.
+    columns = read_data_import_columns(data_import)
+    data_import.file.open('rb')
+    try:
+        with open_csv_stream(data_import.file) as stream:
+            if byte_range is not None:
+                start, end = byte_range
+                # Compressed streams are decompressed up to start (rows before it are not parsed)
+                stream.seek(start)
+                yield from _read_chunks_with_arrow(stream, columns, read_options, skip_rows, nrows, size=end - start)
+            elif use_arrow_engine(data_import):
+                # Header
+                stream.readline()
+                yield from _read_chunks_with_arrow(stream, columns, read_options, skip_rows, nrows)
+            else:
+                yield from _read_chunks_with_pandas(stream, columns, read_options, chunk_size, skip_rows, nrows)
+    finally:
+        data_import.file.close()
+
+
+def read_data_import_column_values(data_import, column):
+    """
+    Return the float values of a column of the whole upload, only this column is parsed.
+    """
+    file_format = get_file_format(data_import.file.name)
+    data_import.file.open('rb')
+    try:
+        if file_format in FileFormat.COLUMNAR:
+            names = [
+                name
+                for name in read_columnar_file_columns(data_import.file, file_format)
+                if format_column(name) == column
+            ]
+            if file_format == FileFormat.PARQUET:
+                arrays = pa_parquet.read_table(data_import.file, columns=names).column(0).chunks
+            else:
+                # Other columns of a record batch are dropped right away
+                reader = pa.ipc.open_file(data_import.file)
+                arrays = [
+                    reader.get_batch(index).column(names[0])
+                    for index in range(reader.num_record_batches)
+                ]
+            values = [array.cast(pa.float64()).to_numpy(zero_copy_only=False) for array in arrays]
+        else:
+            with open_csv_stream(data_import.file) as stream:
+                values = [
+                    df.iloc[:, 0].to_numpy()
+                    for df in pd.read_csv(
+                        stream,
+                        delimiter=',',
+                        usecols=lambda name: format_column(name) == column,
+                        dtype='float64',
+                        chunksize=IMPORT_CHUNK_SIZE * 10,
+                    )
+                ]
+        return np.concatenate([*values, np.array([], dtype=float)]).astype(float)
+    finally:
+        data_import.file.close()
+
+
+def get_data_import_parts(data_import, part_rows, part_bytes):
+    """
+    Split the upload into parts processed separately, return read_data_import_chunks kwargs of each part.
+    CSV is split into byte ranges of about part_bytes, so that each part seeks to its rows
+    instead of parsing (and skipping) all the rows before them. Parquet is split by row count (from the metadata),
+    Feather by record batches of about part_bytes (row counts would need reading the batches).
+    """
+    file_format = get_file_format(data_import.file.name)
+    data_import.file.open('rb')
+    try:
+        if file_format == FileFormat.PARQUET:
+            row_count = pa_parquet.ParquetFile(data_import.file).metadata.num_rows
+            return [
+                dict(skip_rows=skip_rows, nrows=part_rows)
+                for skip_rows in range(0, row_count, part_rows)
+            ]
+        if file_format == FileFormat.FEATHER:
+            batch_count = pa.ipc.open_file(data_import.file).num_record_batches
+            part_batches = max(round(part_bytes * batch_count / data_import.file.size), 1) if batch_count else 1
+            return [
+                dict(record_batches=(start, min(start + part_batches, batch_count)))
+                for start in range(0, batch_count, part_batches)
+            ]
+        with open_csv_stream(data_import.file) as stream:
+            return [
+                dict(byte_range=row_range)
+                for row_range in get_csv_row_ranges(stream, part_bytes)
+            ]
+    finally:
+        data_import.file.close()
+
+
+def estimate_file_size(file):
+    """
+    Return estimated (row count, uncompressed bytes) of an upload, without reading it fully (row count is None
+    for Feather).
+    CSV row size comes from a sample of the first rows. Uncompressed size of zip is stored in the archive,
+    for gzip it comes from the compression ratio of the sample.
+    """
+    file_format = get_file_format(file.name)
+    file.seek(0)
+    uncompressed_bytes = None
+    try:
+        if file_format == FileFormat.PARQUET:
+            metadata = pa_parquet.ParquetFile(file).metadata
+            return metadata.num_rows, sum(
+                metadata.row_group(index).total_byte_size
+                for index in range(metadata.num_row_groups)
+            )
+        if file_format == FileFormat.FEATHER:
+            # Rows are not counted (pyarrow reads the record batches to count them)
+            return None, file.size
+        if get_file_compression(file.name) == FileCompression.ZIP:
+            with zipfile.ZipFile(file) as archive:
+                uncompressed_bytes = get_zip_member(archive).file_size
+        file.seek(0)
+        with open_csv_stream(file) as stream:
+            sample = stream.read(IMPORT_ESTIMATE_SAMPLE_SIZE)
+            consumed_bytes = file.tell()
+    finally:
+        file.seek(0)
+    if not sample:
+        return 0, 0
+    if uncompressed_bytes is None:
+        uncompressed_bytes = file.size * len(sample) / consumed_bytes if consumed_bytes else file.size
+    # First line is the header
+    row_bytes = len(sample) / max(sample.count(b'\n'), 1)
+    return max(round(uncompressed_bytes / row_bytes) - 1, 0), round(uncompressed_bytes)
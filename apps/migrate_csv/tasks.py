@@ -1,56 +1,524 @@
 import logging
-import pandas as pd
-from celery import shared_task
+import math
+import time
+from datetime import timedelta
 
-from .models import DataImport
-from .outlier_detect import detect_outliers
+from celery import chord, shared_task
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from .admission import acquire_heavy_import_slot, release_heavy_import_slot
+from .models import DataImport, get_file_checksum
+from .loaders import (
+    clone_preview_rows,
+    get_production_column_map,
+    get_transaction_id,
+    get_transaction_status,
+    insert_preview_rows,
+    migrate_preview_rows,
+)
+from .metrics import ImportMetrics
+from .outlier_detect import detect_outliers, get_upload_compare_data, update_outlier_baselines
+from .partitions import truncate_preview_partition
+from .readers import estimate_file_size, get_data_import_parts, read_data_import_chunks
 
 logger = logging.getLogger(__name__)
 
+# Uploads larger than this (in bytes) are split into row ranges processed by parallel subtasks
+IMPORT_PARALLEL_FILE_SIZE_THRESHOLD = 50 * 1024 * 1024
+# Number of rows (typed files) or bytes (CSV) processed by each subtask
+IMPORT_PARALLEL_PART_SIZE = 100000
+IMPORT_PARALLEL_PART_BYTES = 32 * 1024 * 1024
+# Memory used by an import before reading any row (MB)
+IMPORT_MEMORY_BASE_MB = 200
+# Memory used per byte of (decompressed) upload, measured with the benchmark_data_import command
+IMPORT_MEMORY_SIZE_FACTOR = 3
+# Number of reviewed previews written to production database per transaction
+MIGRATE_BATCH_SIZE = 1000
+# Imports with more previews than this are reviewed by a celery task in batches
+REVIEW_ASYNC_ROW_THRESHOLD = 50000
+# Number of previews marked as reviewed per UPDATE (celery task)
+REVIEW_BATCH_SIZE = 10000
+# Number of previews deleted per DELETE by cleanup tasks (non-partitioned tables)
+CLEANUP_BATCH_SIZE = 5000
+# Pause (in seconds) between cleanup batches, to leave room for live queries
+CLEANUP_BATCH_SLEEP = 0.5
+# Previews of failed imports not updated since this long are removed
+CLEANUP_FAILED_IMPORT_AGE = timedelta(days=7)
+
+
+def estimate_data_import_memory_mb(data_import):
+    """
+    Estimate peak memory of processing the upload from its (decompressed) size and row count.
+    """
+    row_count, uncompressed_bytes = estimate_file_size(data_import.file)
+    logger.info(f'DataImport(pk:{data_import.pk}) estimated rows: {row_count} bytes: {uncompressed_bytes}')
+    return math.ceil(IMPORT_MEMORY_BASE_MB + uncompressed_bytes * IMPORT_MEMORY_SIZE_FACTOR / (1024 * 1024))
+
+
+def get_data_import_queue(data_import):
+    # None: default queue
+    if data_import.is_heavy:
+        return settings.IMPORT_HEAVY_QUEUE
+
 
-def format_column(column):
-    # Lower all columns name
-    return column.lower().replace(' ', '_')
+def process_data_import_rows(data_import, metrics, upload_compare_data, **part):
+    """
+    Process a part (see readers.get_data_import_parts) in a single transaction (used by parallel parts).
+    upload_compare_data: see outlier_detect.get_upload_compare_data, computed once for all the parts
+    """
+    PREVIEW_MODEL = data_import.preview_model
+    with transaction.atomic():
+        row_count = outlier_count = 0
+        # Only one chunk is kept in memory, previews are written chunk by chunk.
+        chunks = read_data_import_chunks(data_import, **part)
+        for df in metrics.iter_stage('parse', chunks):
+            outliers = detect_outliers(df, PREVIEW_MODEL, metrics=metrics, upload_compare_data=upload_compare_data)
+            row_count += insert_preview_rows(data_import, df, outliers, metrics=metrics)
+            outlier_count += int(outliers.rows.sum())
+        metrics.add_rows('inserted', row_count)
+        metrics.add_rows('outliers', outlier_count)
+        DataImport.objects.filter(pk=data_import.pk).update(
+            parsed_rows=models.F('parsed_rows') + row_count,
+            inserted_rows=models.F('inserted_rows') + row_count,
+            total_rows=models.F('total_rows') + row_count,
+            outlier_rows=models.F('outlier_rows') + outlier_count,
+        )
+
+
+def process_data_import_with_checkpoint(data_import, metrics):
+    """
+    Process the whole file committing each chunk along with the progress watermark.
+    On retry, processing continues after the last committed chunk.
+    """
+    PREVIEW_MODEL = data_import.preview_model
+    if data_import.inserted_rows:
+        logger.info(f'Resuming DataImport(pk:{data_import.pk}) after row: {data_import.inserted_rows}')
+    chunk_index = data_import.last_committed_chunk + 1 if data_import.last_committed_chunk is not None else 0
+    # From the whole upload (including rows committed before a resume)
+    with metrics.stage('outlier_compare_data'):
+        upload_compare_data = get_upload_compare_data(data_import)
+    # Only one chunk is kept in memory, previews are written chunk by chunk.
+    chunks = read_data_import_chunks(data_import, skip_rows=data_import.inserted_rows)
+    for df in metrics.iter_stage('parse', chunks):
+        data_import.parsed_rows = data_import.inserted_rows + len(df)
+        data_import.save(update_fields=('parsed_rows',))
+        outliers = detect_outliers(df, PREVIEW_MODEL, metrics=metrics, upload_compare_data=upload_compare_data)
+        outlier_count = int(outliers.rows.sum())
+        with transaction.atomic():
+            row_count = insert_preview_rows(data_import, df, outliers, metrics=metrics)
+            data_import.inserted_rows += row_count
+            data_import.last_committed_chunk = chunk_index
+            data_import.total_rows = data_import.inserted_rows
+            data_import.outlier_rows += outlier_count
+            data_import.save(update_fields=('inserted_rows', 'last_committed_chunk', 'total_rows', 'outlier_rows'))
+        metrics.add_rows('inserted', row_count)
+        metrics.add_rows('outliers', outlier_count)
+        chunk_index += 1
 
 
 @shared_task
-def process_data_import(pk):
+def process_data_import_part(pk, part, upload_compare_data):
+    """
+    Return metrics of the part, None on failure.
+    """
+    data_import = DataImport.objects.get(pk=pk)
+    metrics = ImportMetrics()
+    try:
+        with metrics.stage('total'), metrics.track_peak_rss():
+            process_data_import_rows(data_import, metrics, upload_compare_data, **part)
+    except Exception:
+        logger.error(f'Failed to process DataImport(pk: {pk}) part: {part}', exc_info=True)
+        return
+    return metrics.as_dict()
+
+
+def save_processed_data_import(data_import, update_fields):
+    """
+    Save the outcome of processing, unless the import is no longer PROCESSING (deleted meanwhile).
+    """
+    if not DataImport.objects.filter(pk=data_import.pk, status=DataImport.Status.PROCESSING).update(
+        **{field: getattr(data_import, field) for field in update_fields}
+    ):
+        logger.warning(f'DataImport(pk:{data_import.pk}) is no longer processing, status not saved')
+
+
+def reset_data_import_parts(data_import):
+    # Remove previews from successful parts so that the import can be re-processed.
+    if not truncate_preview_partition(data_import.preview_model, data_import.pk):
+        data_import.preview_model.objects.filter(importer=data_import).delete()
+    data_import.status = DataImport.Status.FAILED_PROCESSING
+    data_import.parsed_rows = data_import.inserted_rows = 0
+    data_import.total_rows = data_import.outlier_rows = 0
+
+
+@shared_task
+def finalize_data_import_parts(results, pk):
+    data_import = DataImport.objects.get(pk=pk)
+    metrics = ImportMetrics(data_import.metrics)
+    for part_metrics in results:
+        if part_metrics is not None:
+            metrics.merge(part_metrics)
+    data_import.metrics = metrics.as_dict()
+    if all(part_metrics is not None for part_metrics in results):
+        data_import.status = DataImport.Status.PREVIEW
+    else:
+        reset_data_import_parts(data_import)
+    save_processed_data_import(
+        data_import,
+        ('status', 'parsed_rows', 'inserted_rows', 'total_rows', 'outlier_rows', 'metrics'),
+    )
+    if data_import.is_heavy:
+        release_heavy_import_slot(pk)
+
+
+@shared_task
+def fail_data_import_parts(request, exc, traceback, pk):
+    """
+    Error callback of the parts chord: a part was lost (killed by the time limit or OOM),
+    so finalize_data_import_parts won't run.
+    """
+    logger.error(f'Failed to process DataImport(pk: {pk}) parts: {exc!r}')
+    data_import = DataImport.objects.get(pk=pk)
+    reset_data_import_parts(data_import)
+    save_processed_data_import(data_import, ('status', 'parsed_rows', 'inserted_rows', 'total_rows', 'outlier_rows'))
+    if data_import.is_heavy:
+        release_heavy_import_slot(pk)
+
+
+@shared_task
+def fail_data_import(request, exc, traceback, pk):
+    """
+    Error callback of process_data_import: the task was lost (killed by the time limit or OOM).
+    Previews up to the watermark are kept, the import is resumed when processed again.
+    """
+    logger.error(f'Failed to process DataImport(pk: {pk}): {exc!r}')
+    DataImport.objects.filter(pk=pk, status=DataImport.Status.PROCESSING).update(
+        status=DataImport.Status.FAILED_PROCESSING,
+    )
+    data_import = DataImport.objects.filter(pk=pk).first()
+    if data_import is not None and data_import.is_heavy:
+        release_heavy_import_slot(pk)
+
+
+def process_data_import_in_parts(data_import, metrics):
+    with metrics.stage('split'):
+        parts = get_data_import_parts(data_import, IMPORT_PARALLEL_PART_SIZE, IMPORT_PARALLEL_PART_BYTES)
+    with metrics.stage('outlier_compare_data'):
+        upload_compare_data = get_upload_compare_data(data_import)
+    data_import.metrics = metrics.as_dict()
+    data_import.save(update_fields=('metrics',))
+    # Parts of heavy imports stay on the heavy queue
+    queue = get_data_import_queue(data_import)
+    chord(
+        process_data_import_part.s(data_import.pk, part, upload_compare_data).set(queue=queue)
+        for part in parts
+    )(
+        finalize_data_import_parts.s(data_import.pk).on_error(fail_data_import_parts.s(data_import.pk))
+    )
+
+
+@shared_task(bind=True)
+def process_data_import(self, pk):
     data_import = DataImport.objects.get(pk=pk)
     if data_import.status not in [DataImport.Status.FAILED_PROCESSING, DataImport.Status.PENDING]:
         logger.warning(f'Not processing with DataImport(pk:{pk}) status: {data_import.status}')
         return
+    existing_preview = data_import.preview_model.objects.filter(importer=data_import)
+    # Previews up to the watermark are from previous runs (resumed below)
+    if not data_import.inserted_rows and existing_preview.exists():
+        logger.warning(f'Not processing with DataImport(pk:{pk}) Preview already exists: {existing_preview.count()}')
+        return
+
+    if data_import.estimated_memory_mb is None:
+        data_import.estimated_memory_mb = estimate_data_import_memory_mb(data_import)
+        data_import.save(update_fields=('estimated_memory_mb',))
+    # Heavy imports wait (on the queue) until one of IMPORT_HEAVY_MAX_CONCURRENCY slots is free
+    if data_import.is_heavy and not acquire_heavy_import_slot(pk):
+        logger.info(f'DataImport(pk:{pk}) waiting for a heavy import slot')
+        raise self.retry(countdown=settings.IMPORT_HEAVY_RETRY_DELAY, max_retries=None)
+
+    # Claim the import, PROCESSING imports can't be canceled (see admin cancel_data_imports)
+    if not DataImport.objects.filter(
+        pk=pk,
+        status__in=[DataImport.Status.FAILED_PROCESSING, DataImport.Status.PENDING],
+    ).update(status=DataImport.Status.PROCESSING):
+        logger.warning(f'Not processing with DataImport(pk:{pk}) status changed')
+        if data_import.is_heavy:
+            release_heavy_import_slot(pk)
+        return
+    data_import.status = DataImport.Status.PROCESSING
 
+    in_parts = False
     try:
-        PREVIEW_MODEL = data_import.preview_model
-        existing_preview = PREVIEW_MODEL.objects.filter(importer=data_import)
-        if existing_preview.exists():
-            logger.warning(f'Not processing with DataImport(pk:{pk}) Preview already exists: {existing_preview.count()}')
-            return
-
-        df = pd.read_csv(data_import.file, delimiter=',')
-        df = df.rename(columns=format_column)
-        outliers, _ = detect_outliers(df, PREVIEW_MODEL)
-        new_preview_objects = []
-        for index, row in df.iterrows():
-            outlier_data = list({
-                column
-                for column, indexes in outliers.items()
-                if index in indexes   # indexes is set
-            })
-            new_preview_objects.append(
-                PREVIEW_MODEL(
-                    importer=data_import,
-                    no_outlier=not outlier_data,
-                    outlier_data=outlier_data,
-                    **{
-                        column: row[column]
-                        for column in PREVIEW_MODEL.CSV_HEADERS
-                    }
-                )
+        in_parts = _process_data_import(data_import)
+    finally:
+        # Slot of parallel processing is released by finalize_data_import_parts
+        if data_import.is_heavy and not in_parts:
+            release_heavy_import_slot(pk)
+
+
+def _process_data_import(data_import):
+    """
+    Return True if the import is dispatched to parallel parts.
+    """
+    pk = data_import.pk
+    # Stages of previous runs (and validation) are kept, durations add up on resume.
+    metrics = ImportMetrics(data_import.metrics)
+    with metrics.track_peak_rss():
+        try:
+            with metrics.stage('dedupe'):
+                duplicate_data_import = None
+                if not data_import.inserted_rows:
+                    if not data_import.checksum:
+                        # Hashes the whole file, so it is done here instead of in the upload request
+                        data_import.file.open('rb')
+                        try:
+                            data_import.checksum = get_file_checksum(data_import.file)
+                        finally:
+                            data_import.file.close()
+                        data_import.save(update_fields=('checksum',))
+                    duplicate_data_import = data_import.get_processed_duplicate()
+            if duplicate_data_import:
+                # Same file is already processed, re-use its previews instead of parsing again.
+                with metrics.stage('clone'), transaction.atomic():
+                    count = clone_preview_rows(duplicate_data_import, data_import)
+                    metrics.add_rows('inserted', count)
+                    data_import.parsed_rows = data_import.inserted_rows = count
+                    data_import.save(update_fields=('parsed_rows', 'inserted_rows'))
+                    DataImport.update_preview_counters([data_import.pk])
+                logger.info(f'DataImport(pk:{pk}) {count} previews cloned from DataImport(pk:{duplicate_data_import.pk})')
+                data_import.status = DataImport.Status.PREVIEW
+            elif not data_import.inserted_rows and data_import.file.size >= IMPORT_PARALLEL_FILE_SIZE_THRESHOLD:
+                # Status is updated by finalize_data_import_parts
+                process_data_import_in_parts(data_import, metrics)
+                return True
+            else:
+                with metrics.stage('total'):
+                    process_data_import_with_checkpoint(data_import, metrics)
+                data_import.status = DataImport.Status.PREVIEW
+        except Exception:
+            logger.error(f'Failed to process DataImport(pk: {pk})', exc_info=True)
+            data_import.status = DataImport.Status.FAILED_PROCESSING
+    data_import.metrics = metrics.as_dict()
+    save_processed_data_import(data_import, ('status', 'metrics'))
+    return False
+
+
+def save_migration_checkpoint(data_import, transaction_id=None, preview_id=None):
+    data_import.migrating_transaction_id = transaction_id
+    data_import.migrating_preview_id = preview_id
+    data_import.save(update_fields=('last_migrated_preview_id', 'migrating_transaction_id', 'migrating_preview_id'))
+
+
+def resolve_migrating_batch(data_import):
+    """
+    Advance the checkpoint if the batch in flight of an interrupted migration was committed to production.
+    """
+    if data_import.migrating_transaction_id is None:
+        return
+    transaction_status = get_transaction_status(
+        data_import.migrating_transaction_id,
+        using=settings.RCCE_PRODUCTION_DB,
+    )
+    if transaction_status == 'committed':
+        data_import.last_migrated_preview_id = data_import.migrating_preview_id
+    elif transaction_status != 'aborted':
+        # Still running or unknown: re-running the batch could duplicate its rows
+        raise Exception(
+            f'Production transaction {data_import.migrating_transaction_id} status is {transaction_status}'
+        )
+    save_migration_checkpoint(data_import)
+
+
+@shared_task
+def migrate_data_import(pk, user_id=None):
+    """
+    Write reviewed previews to production database in batches ordered by preview id.
+    Progress is saved after each batch, so a failed migration resumes from the last batch.
+    Each production transaction id is recorded before its commit, so a batch interrupted between the
+    production commit and the checkpoint is neither lost nor written twice (see resolve_migrating_batch).
+    """
+    data_import = DataImport.objects.get(pk=pk)
+    # Claim the import, so that concurrent runs don't write the same batches
+    if not DataImport.objects.filter(
+        pk=pk,
+        status__in=[DataImport.Status.PREVIEW, DataImport.Status.FAILED_MIGRATING],
+    ).update(status=DataImport.Status.MIGRATING):
+        logger.warning(f'Not migrating DataImport(pk:{pk}) status: {data_import.status}')
+        return
+
+    PREVIEW_MODEL = data_import.preview_model
+    preview_columns = list(get_production_column_map(PREVIEW_MODEL).keys())
+    reviewed_previews = PREVIEW_MODEL.objects.filter(
+        importer=data_import,
+        is_reviewed=True,
+    ).order_by('pk')
+    try:
+        resolve_migrating_batch(data_import)
+        while True:
+            batch = list(
+                reviewed_previews.filter(
+                    pk__gt=data_import.last_migrated_preview_id or 0,
+                ).values('pk', *preview_columns)[:MIGRATE_BATCH_SIZE]
             )
-        PREVIEW_MODEL.objects.bulk_create(new_preview_objects)
-        data_import.status = DataImport.Status.PREVIEW
+            if not batch:
+                break
+            with transaction.atomic(using=settings.RCCE_PRODUCTION_DB):
+                migrate_preview_rows(PREVIEW_MODEL, batch, using=settings.RCCE_PRODUCTION_DB)
+                # Committed (django database) before the production transaction
+                save_migration_checkpoint(
+                    data_import,
+                    transaction_id=get_transaction_id(using=settings.RCCE_PRODUCTION_DB),
+                    preview_id=batch[-1]['pk'],
+                )
+            data_import.last_migrated_preview_id = batch[-1]['pk']
+            save_migration_checkpoint(data_import)
+        data_import.status = DataImport.Status.MIGRATED
+        data_import.migrated_by_id = user_id
+        data_import.migrated_at = timezone.now()
     except Exception:
-        logger.error(f'Failed to process DataImport(pk: {pk})', exc_info=True)
-        data_import.status = DataImport.Status.FAILED_PROCESSING
-    data_import.save(update_fields=('status',))
+        logger.error(f'Failed to migrate DataImport(pk: {pk})', exc_info=True)
+        data_import.status = DataImport.Status.FAILED_MIGRATING
+    DataImport.objects.filter(pk=pk, status=DataImport.Status.MIGRATING).update(
+        status=data_import.status,
+        migrated_by_id=data_import.migrated_by_id,
+        migrated_at=data_import.migrated_at,
+    )
+
+
+@shared_task
+def fail_migrate_data_import(request, exc, traceback, pk):
+    """
+    Error callback of migrate_data_import: the task was lost (killed by the time limit or OOM).
+    The batch in flight is resolved when the migration is resumed.
+    """
+    logger.error(f'Failed to migrate DataImport(pk: {pk}): {exc!r}')
+    DataImport.objects.filter(pk=pk, status=DataImport.Status.MIGRATING).update(
+        status=DataImport.Status.FAILED_MIGRATING,
+    )
+
+
+def review_data_import_previews(data_import, user_id, only_non_outliers=False, batch_size=None):
+    """
+    Mark previews of the import as reviewed using set-based UPDATEs.
+    With batch_size, previews are updated (and committed) batch by batch to keep transactions short.
+    """
+    previews = data_import.preview_model.objects.filter(
+        importer=data_import,
+        is_reviewed=False,
+    )
+    if only_non_outliers:
+        previews = previews.filter(no_outlier=True)
+    review_data = dict(
+        is_reviewed=True,
+        reviewed_by_id=user_id,
+        reviewed_at=timezone.now(),
+    )
+    count = 0
+    if batch_size is None:
+        with transaction.atomic():
+            count = previews.update(**review_data)
+            DataImport.update_preview_counters([data_import.pk])
+        return count
+    while True:
+        with transaction.atomic():
+            batch_count = previews.model.objects.filter(
+                pk__in=models.Subquery(previews.order_by('pk').values('pk')[:batch_size]),
+            ).update(**review_data)
+            # Counted with the batch, without recounting all the previews of the import
+            DataImport.objects.filter(pk=data_import.pk).update(
+                reviewed_rows=models.F('reviewed_rows') + batch_count,
+            )
+        count += batch_count
+        if batch_count < batch_size:
+            break
+    # Previews changed meanwhile (eg: deleted in the admin) are counted once at the end
+    DataImport.update_preview_counters([data_import.pk])
+    return count
+
+
+@shared_task
+def review_data_import(pk, user_id, only_non_outliers=False):
+    data_import = DataImport.objects.get(pk=pk)
+    if data_import.status != DataImport.Status.PREVIEW:
+        logger.warning(f'Not reviewing DataImport(pk:{pk}) status: {data_import.status}')
+        return
+    count = review_data_import_previews(
+        data_import, user_id, only_non_outliers=only_non_outliers, batch_size=REVIEW_BATCH_SIZE,
+    )
+    logger.info(f'DataImport(pk:{pk}) {count} previews marked as reviewed')
+
+
+def delete_data_import_previews(data_import):
+    """
+    Remove all previews of the import and reset its progress and counters.
+    Partitioned tables are truncated, otherwise previews are deleted in throttled batches.
+    """
+    PREVIEW_MODEL = data_import.preview_model
+    if not truncate_preview_partition(PREVIEW_MODEL, data_import.pk):
+        previews = PREVIEW_MODEL.objects.filter(importer=data_import)
+        while True:
+            batch_count, _ = PREVIEW_MODEL.objects.filter(
+                pk__in=models.Subquery(previews.order_by('pk').values('pk')[:CLEANUP_BATCH_SIZE]),
+            ).delete()
+            if batch_count < CLEANUP_BATCH_SIZE:
+                break
+            time.sleep(CLEANUP_BATCH_SLEEP)
+    DataImport.objects.filter(pk=data_import.pk).update(
+        parsed_rows=0,
+        inserted_rows=0,
+        last_committed_chunk=None,
+        total_rows=0,
+        reviewed_rows=0,
+        outlier_rows=0,
+    )
+
+
+@shared_task
+def cleanup_data_import(pk):
+    data_import = DataImport.objects.get(pk=pk)
+    # Previews of FAILED_MIGRATING imports are partially published, they are needed to complete the migration
+    if data_import.status not in [DataImport.Status.CANCELED, DataImport.Status.FAILED_PROCESSING]:
+        logger.warning(f'Not cleaning DataImport(pk:{pk}) status: {data_import.status}')
+        return
+    delete_data_import_previews(data_import)
+    logger.info(f'DataImport(pk:{pk}) previews removed')
+
+
+@shared_task
+def cleanup_data_imports():
+    """
+    Periodic: remove previews of canceled imports and of failed processing imports left untouched.
+    """
+    data_import_pks = list(
+        DataImport.objects.filter(
+            models.Q(status=DataImport.Status.CANCELED) |
+            models.Q(
+                status=DataImport.Status.FAILED_PROCESSING,
+                updated_at__lt=timezone.now() - CLEANUP_FAILED_IMPORT_AGE,
+            ),
+        ).filter(
+            models.Q(total_rows__gt=0) | models.Q(inserted_rows__gt=0),
+        ).values_list('pk', flat=True)
+    )
+    for pk in data_import_pks:
+        cleanup_data_import(pk)
+    logger.info(f'Cleaned up {len(data_import_pks)} imports')
+
+
+@shared_task
+def delete_data_import(pk):
+    data_import = DataImport.objects.filter(pk=pk).first()
+    if data_import is None:
+        return
+    delete_data_import_previews(data_import)
+    data_import.delete()
+    logger.info(f'DataImport(pk:{pk}) deleted')
+
+
+@shared_task
+def refresh_outlier_baselines():
+    count = update_outlier_baselines()
+    logger.info(f'Updated {count} outlier baselines')
@@ -1,3 +1,303 @@
-# from django.test import TestCase
+import datetime
+import gzip
+import io
+import os
+import tempfile
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.test import SimpleTestCase
+
+from . import outlier_detect, readers
+from .benchmark import generate_import_df
+from .models import DataImport, ImportUserDataPreview, ImportUserSourceDataPreview, IndicatorDataOutlierBaseline
+from .outlier_detect import detect_outliers, get_upload_compare_data
+from .readers import find_csv_row_boundary, get_csv_line_breaks, read_data_import_chunks
+
+
+def get_zip_content(name, content):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+class DataImportFileTestCase(SimpleTestCase):
+    """
+    DataImport (not saved) using a temporary file, no database or storage is used.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def get_data_import(self, content, name='upload.csv', file_type=DataImport.FileType.USER):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(content)
+        data_import = DataImport(file_type=file_type)
+        data_import.file = File(open(path, 'rb'), name=path)
+        self.addCleanup(data_import.file.file.close)
+        return data_import
+
+    def get_csv_content(self, size, seed=1, comments=None):
+        """
+        Synthetic import CSV, comments: row index -> raw CSV value of the comment column
+        """
+        df = generate_import_df(ImportUserDataPreview, size, rng=np.random.default_rng(seed))
+        df['comment'] = df['comment'].astype(object)
+        placeholders = {}
+        for index, value in (comments or {}).items():
+            df.loc[index, 'comment'] = placeholders[value] = f'comment-placeholder-{index}'
+        content = df.to_csv(index=False, date_format='%Y-%m-%d')
+        for value, placeholder in placeholders.items():
+            content = content.replace(placeholder, value)
+        return content.encode()
+
+    def read_rows(self, data_import, **kwargs):
+        return pd.concat(
+            [df.astype(object) for df in read_data_import_chunks(data_import, **kwargs)],
+            ignore_index=True,
+        )
+
+
+class CsvQuoteTest(DataImportFileTestCase):
+    # Unquoted value with a quote (kept as is by pandas and pyarrow), then a quoted value with line breaks
+    COMMENTS = {
+        100: 'pipe 12" inch',
+        300: '"first line\nsecond, ""quoted"", line"',
+    }
+
+    def test_line_breaks(self):
+        data = b'a,pipe 12" inch\nb,"first\nsecond ""x"", y"\nc,"d"e"\nf,"\n'
+        line_breaks, is_quoted = get_csv_line_breaks(data)
+        self.assertEqual(is_quoted.tolist(), [False, True, False, False, True])
+        self.assertEqual(find_csv_row_boundary(data), len(b'a,pipe 12" inch\nb,"first\nsecond ""x"", y"\nc,"d"e"\n'))
+        self.assertEqual(find_csv_row_boundary(b'a,"b\nc'), 0)
+
+    def test_arrow_engine(self):
+        data_import = self.get_data_import(self.get_csv_content(2000, comments=self.COMMENTS))
+        expected_df = self.read_rows(data_import)
+        with mock.patch.object(readers, 'IMPORT_ARROW_FILE_SIZE_THRESHOLD', 0):
+            df = self.read_rows(data_import)
+        self.assertEqual(len(df), 2000)
+        self.assertEqual(df['comment'].tolist(), expected_df['comment'].tolist())
+        self.assertEqual(df.loc[100, 'comment'], 'pipe 12" inch')
+        self.assertEqual(df.loc[300, 'comment'], 'first line\nsecond, "quoted", line')
+
+
+class DataImportValidationTest(DataImportFileTestCase):
+    def test_damaged_file(self):
+        content = self.get_csv_content(3000)
+        for name, damaged_content in [
+            # Header (checked by the validator) is complete, the estimate reads up to the end of the data
+            ('upload.csv.gz', gzip.compress(content)[:10000]),
+            ('upload.csv.zip', get_zip_content('upload.csv', content)[:10000]),
+        ]:
+            with self.subTest(name=name):
+                data_import = self.get_data_import(damaged_content, name=name)
+                with self.assertRaises(ValidationError):
+                    data_import.clean()
+
+    def test_estimate(self):
+        data_import = self.get_data_import(gzip.compress(self.get_csv_content(3000)), name='upload.csv.gz')
+        data_import.clean()
+        self.assertIsNotNone(data_import.estimated_memory_mb)
+
+
+class DetectOutliersTest(SimpleTestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'iso3': ['NPL', 'NPL', 'IND'],
+            'indicator_id': ['ind1', 'ind1', 'ind2'],
+            'subindicator': ['sub1', 'sub1', 'sub1'],
+            'adminlevel1': ['', '', ''],
+            'area': ['', '', ''],
+            'gender': ['female', 'male', ''],
+            'age_group': ['', '', ''],
+            'target_group': ['', '', ''],
+            'percentage': [10.0, 12.0, 90.0],
+        })
+        self.baselines = mock.patch.object(IndicatorDataOutlierBaseline, 'objects').start()
+        self.addCleanup(mock.patch.stopall)
+        self.set_baselines([])
+        # Scoring is tested with history DataFrames, see test_history_*
+        self.history = mock.patch.object(outlier_detect, 'get_indicator_data_history').start()
+        self.history.return_value = self.get_history_df([])
+
+    def set_baselines(self, baselines):
+        self.baselines.filter.return_value.values.return_value = baselines
+
+    def test_no_compare_data(self):
+        # New indicators: nothing to compare with, rows are not flagged
+        outliers = detect_outliers(self.df, ImportUserDataPreview)
+        self.assertEqual(outliers.columns, ['percentage'])
+        self.assertEqual(outliers.mask.shape, (3, 1))
+        self.assertFalse(outliers.rows.any())
+
+    def test_baseline(self):
+        self.set_baselines([
+            dict(
+                indicator_id='ind2', subvariable='sub1', count=100, mean=20, m2=2500, mad=5,
+                quantiles={'0.25': 15, '0.5': 20, '0.75': 25},
+            ),
+        ])
+        outliers = detect_outliers(self.df, ImportUserDataPreview)
+        self.assertEqual(outliers.rows.tolist(), [False, False, True])
+
+    def get_history_df(self, history):
+        return pd.DataFrame.from_records(
+            history,
+            columns=[*outlier_detect.get_history_columns().values(), 'month', 'value'],
+        )
+
+    def get_history(self, gender, values):
+        return [
+            dict(
+                iso3='NPL', indicator_id='ind1', subvariable='sub1',
+                admin_level_1=None, area='', gender=gender, age_group=None, target_group='',
+                month=datetime.date(2026, month, 1), value=value,
+            )
+            for month, value in enumerate(values, start=1)
+        ]
+
+    def detect_history_outliers(self, history):
+        compare_data = outlier_detect.get_outlier_compare_data_from_history(self.df, self.get_history_df(history))
+        return outlier_detect.history_detector(self.df['percentage'], compare_data).fillna(False).tolist()
+
+    def test_history_min_months(self):
+        self.assertEqual(self.detect_history_outliers(self.get_history('female', [40, 41])), [False, False, False])
+
+    def test_history_disaggregation(self):
+        self.assertEqual(
+            self.detect_history_outliers(
+                self.get_history('female', [40, 41, 42]) + self.get_history('male', [12, 11, 12])
+            ),
+            [True, False, False],
+        )
+
+    def test_history_detector(self):
+        self.history.return_value = self.get_history_df(self.get_history('female', [40, 41, 42]))
+        outliers = detect_outliers(self.df, ImportUserDataPreview)
+        self.assertEqual(outliers.rows.tolist(), [True, False, False])
+
+
+class UploadOutliersTest(DataImportFileTestCase):
+    def get_outlier_rows(self, data_import, chunk_size):
+        upload_compare_data = get_upload_compare_data(data_import)
+        return np.concatenate([
+            detect_outliers(df, ImportUserSourceDataPreview, upload_compare_data=upload_compare_data).rows
+            for df in read_data_import_chunks(data_import, chunk_size=chunk_size)
+        ])
+
+    def test_chunk_size(self):
+        df = generate_import_df(ImportUserSourceDataPreview, 2000, rng=np.random.default_rng(1))
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        for name, content in [
+            ('upload.csv', df.to_csv(index=False, date_format='%Y-%m-%d').encode()),
+            ('upload.parquet', buffer.getvalue()),
+        ]:
+            with self.subTest(name=name):
+                data_import = self.get_data_import(content, name=name, file_type=DataImport.FileType.USER_SOURCE)
+                expected_rows = detect_outliers(df, ImportUserSourceDataPreview).rows
+                self.assertTrue(expected_rows.any())
+                for chunk_size in [7, 500, 2000]:
+                    self.assertEqual(self.get_outlier_rows(data_import, chunk_size).tolist(), expected_rows.tolist())
+
+
+class DataImportReadTest(DataImportFileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = self.get_csv_content(3000, comments={
+            # Quoted line breaks all over the file, so that part boundaries fall inside quoted values
+            index: '"multi\nline, ""comment"""'
+            for index in range(0, 3000, 7)
+        })
+        self.expected_df = pd.read_csv(
+            io.BytesIO(self.content),
+            **readers.get_preview_model_read_options(ImportUserDataPreview),
+        ).astype(object)
+
+    def assertRowsEqual(self, df, expected_df):
+        self.assertEqual(len(df), len(expected_df))
+        for column in ['iso3', 'indicator_id', 'comment']:
+            self.assertEqual(df[column].tolist(), expected_df[column].tolist(), column)
+        # Last digit can differ between pandas and pyarrow float parsers
+        np.testing.assert_allclose(df['percentage'].astype(float), expected_df['percentage'].astype(float))
+
+    def test_parts(self):
+        for name, content in [
+            ('upload.csv', self.content),
+            ('upload.csv.gz', gzip.compress(self.content)),
+            ('upload.csv.zip', get_zip_content('upload.csv', self.content)),
+        ]:
+            with self.subTest(name=name):
+                data_import = self.get_data_import(content, name=name)
+                parts = readers.get_data_import_parts(data_import, 1000, 20000)
+                part_sizes = [end - start for start, end in (part['byte_range'] for part in parts)]
+                self.assertGreater(len(parts), 10)
+                self.assertLess(max(part_sizes[:-1]), 3 * 20000)
+                self.assertRowsEqual(
+                    pd.concat([self.read_rows(data_import, **part) for part in parts], ignore_index=True),
+                    self.expected_df,
+                )
+
+    def test_parts_with_stray_quote(self):
+        data_import = self.get_data_import(self.get_csv_content(3000, comments={
+            10: 'pipe 12" inch',
+            20: '"multi\nline"',
+        }))
+        parts = readers.get_data_import_parts(data_import, 1000, 20000)
+        part_sizes = [end - start for start, end in (part['byte_range'] for part in parts)]
+        self.assertLess(max(part_sizes[:-1]), 3 * 20000)
+        self.assertEqual(sum(len(self.read_rows(data_import, **part)) for part in parts), 3000)
+
+    def test_resume(self):
+        for name, arrow_threshold in [('pandas', readers.IMPORT_ARROW_FILE_SIZE_THRESHOLD), ('arrow', 0)]:
+            with self.subTest(engine=name), \
+                    mock.patch.object(readers, 'IMPORT_ARROW_FILE_SIZE_THRESHOLD', arrow_threshold):
+                data_import = self.get_data_import(self.content)
+                self.assertRowsEqual(
+                    self.read_rows(data_import, skip_rows=1234),
+                    self.expected_df.iloc[1234:].reset_index(drop=True),
+                )
+                self.assertRowsEqual(
+                    self.read_rows(data_import, skip_rows=1234, nrows=100),
+                    self.expected_df.iloc[1234:1334].reset_index(drop=True),
+                )
+
+    def test_engine_dtypes(self):
+        data_import = self.get_data_import(self.content)
+        pandas_df = next(read_data_import_chunks(data_import))
+        with mock.patch.object(readers, 'IMPORT_ARROW_FILE_SIZE_THRESHOLD', 0):
+            arrow_df = next(read_data_import_chunks(data_import))
+        self.assertEqual(arrow_df.dtypes.astype(str).to_dict(), pandas_df.dtypes.astype(str).to_dict())
+
+
+class FeatherReadTest(DataImportFileTestCase):
+    def get_feather_content(self, df, compression, batch_rows):
+        buffer = io.BytesIO()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.ipc.new_file(buffer, table.schema, options=pa.ipc.IpcWriteOptions(compression=compression)) as writer:
+            writer.write_table(table, max_chunksize=batch_rows)
+        return buffer.getvalue()
+
+    def test_parts(self):
+        df = generate_import_df(ImportUserDataPreview, 3000, rng=np.random.default_rng(1))
+        for compression, size in [(None, 3000), ('zstd', 3000), (None, 0)]:
+            with self.subTest(compression=compression, size=size):
+                content = self.get_feather_content(df.iloc[:size], compression, batch_rows=100)
+                data_import = self.get_data_import(content, name='upload.feather')
+                self.assertEqual(readers.estimate_file_size(data_import.file), (None, len(content)))
+                parts = readers.get_data_import_parts(data_import, 1000, len(content) // 5)
+                self.assertEqual(len(parts), 5 if size else 0)
+                rows = [self.read_rows(data_import, **part) for part in parts]
+                self.assertEqual(sum(len(part_df) for part_df in rows), size)
+                if size:
+                    self.assertEqual(pd.concat(rows)['indicator_id'].tolist(), df['indicator_id'].tolist())
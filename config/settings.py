@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 import os
 from pathlib import Path
 import environ
+from celery.schedules import crontab
 from config import sentry
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -70,6 +71,19 @@ env = environ.Env(
     CELERY_REDIS_URL=str,  # redis://redis:6379/0
     DJANGO_CACHE_REDIS_URL=str,  # redis://redis:6379/1
 
+    # Data import admission control
+    # -- Imports estimated to use more memory than this (in MB) are heavy
+    IMPORT_HEAVY_MEMORY_THRESHOLD_MB=(int, 1024),
+    # -- Heavy imports run on this celery queue, at most IMPORT_HEAVY_MAX_CONCURRENCY at once
+    IMPORT_HEAVY_QUEUE=(str, 'heavy'),
+    IMPORT_HEAVY_MAX_CONCURRENCY=(int, 1),
+    # -- Processes of the heavy queue worker (parts of a heavy import run in parallel)
+    IMPORT_HEAVY_WORKER_CONCURRENCY=(int, 4),
+    # -- Seconds before a heavy import waiting for a slot is retried
+    IMPORT_HEAVY_RETRY_DELAY=(int, 60),
+    # -- Seconds after which a slot of a lost (killed) import is freed
+    IMPORT_HEAVY_SLOT_TTL=(int, 2 * 60 * 60),
+
     # Http protocol settings
     HTTP_PROTOCOL=(str, 'http'),
 
@@ -297,6 +311,24 @@ CELERY_TIMEZONE = TIME_ZONE
 CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+CELERY_BEAT_SCHEDULE = {
+    'refresh_outlier_baselines': {
+        'task': 'apps.migrate_csv.tasks.refresh_outlier_baselines',
+        'schedule': crontab(minute=0, hour=2),
+    },
+    'cleanup_data_imports': {
+        'task': 'apps.migrate_csv.tasks.cleanup_data_imports',
+        'schedule': crontab(minute=30),
+    },
+}
+
+# Data import admission control (see apps.migrate_csv.admission)
+IMPORT_HEAVY_MEMORY_THRESHOLD_MB = env('IMPORT_HEAVY_MEMORY_THRESHOLD_MB')
+IMPORT_HEAVY_QUEUE = env('IMPORT_HEAVY_QUEUE')
+IMPORT_HEAVY_MAX_CONCURRENCY = env('IMPORT_HEAVY_MAX_CONCURRENCY')
+IMPORT_HEAVY_WORKER_CONCURRENCY = env('IMPORT_HEAVY_WORKER_CONCURRENCY')
+IMPORT_HEAVY_RETRY_DELAY = env('IMPORT_HEAVY_RETRY_DELAY')
+IMPORT_HEAVY_SLOT_TTL = env('IMPORT_HEAVY_SLOT_TTL')
 
 
 CACHES = {
@@ -1,7 +1,10 @@
 #!/bin/bash
 python manage.py collectstatic --noinput &
-python manage.py migrate --noinput &
+# Outlier baselines are otherwise refreshed daily (see CELERY_BEAT_SCHEDULE), rows aren't scored without them
+(python manage.py migrate --noinput && python manage.py refresh_outlier_baselines --if-empty) &
 # start server
 gunicorn config.wsgi:application --timeout=30 --graceful-timeout=1 --bind 0.0.0.0:7020 &
 # FIXME: run this separately celery
-celery -A config worker --loglevel=INFO
+# Heavy imports (see IMPORT_HEAVY_* settings) get their own worker, so small imports keep flowing
+celery -A config worker -Q ${IMPORT_HEAVY_QUEUE:-heavy} --concurrency=${IMPORT_HEAVY_WORKER_CONCURRENCY:-4} -n heavy@%h --loglevel=INFO &
+celery -A config worker --beat --loglevel=INFO